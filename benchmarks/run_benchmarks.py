@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+
+"""
+Time and memory-profile each CytoCAD stage on synthetic BAM files, and check calls against planted CNVs.
+
+Copyright (C) 2021 Tham Cheng Yong
+
+This file is part of CytoCAD.
+
+CytoCAD is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+CytoCAD is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with CytoCAD.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import platform
+import tempfile
+import resource
+import tracemalloc
+from datetime import datetime
+import numpy as np
+import cytocad
+from cytocad.bam_coverage import bam_parse
+from cytocad.depth_limit import ovl_upper
+from cytocad.change_detection import cad_sweep, probe_coverage
+from cytocad.ideogram import draw_ideogram, check_renderer
+from synthetic import PRESETS, hg38_sizes, simulate_bam
+
+STAGES = ('bam_parse', 'probe_coverage', 'ovl_upper', 'cad', 'ideogram')
+
+
+# Parse input
+def bench_parser(args=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description="Benchmark CytoCAD stages on synthetic BAM files.",
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("-s", "--sizes", type=str, metavar="str",
+                        default='chr1x,chr10x,wgs1x',
+                        help="comma-separated presets among %s [chr1x,chr10x,wgs1x]" % ','.join(PRESETS))
+    parser.add_argument("-o", "--out", type=str, metavar="path",
+                        default='bench.json',
+                        help="machine-readable results file [bench.json]")
+    parser.add_argument("-c", "--compare", type=str, metavar="path",
+                        default=None,
+                        help="results file of a previous version to compare with")
+    parser.add_argument("-d", "--data", type=str, metavar="path",
+                        default=os.path.join(tempfile.gettempdir(), 'cytocad_bench'),
+                        help="directory of generated BAM files, reused across runs")
+    parser.add_argument("-r", "--repeat", type=int, metavar="int",
+                        default=3,
+                        help="timed repetitions of each stage, the fastest is kept [3]")
+    parser.add_argument("-t", "--threads", type=int, metavar="int",
+                        default=1,
+                        help="threads passed to bam_parse and cad [1]")
+    parser.add_argument("--read_len", type=int, metavar="int", default=8000,
+                        help="mean read length [8000]")
+    parser.add_argument("--read_sd", type=int, metavar="int", default=6000,
+                        help="standard deviation of read length [6000]")
+    parser.add_argument("--split_rate", type=float, metavar="float", default=0.05,
+                        help="fraction of split reads [0.05]")
+    parser.add_argument("--supp_rate", type=float, metavar="float", default=0.8,
+                        help="fraction of split read parts flagged supplementary, others secondary [0.8]")
+    parser.add_argument("--seed", type=int, metavar="int", default=3,
+                        help="simulation seed [3]")
+    return parser.parse_args(args)
+
+
+def main():
+    args = bench_parser()
+    os.makedirs(args.data, exist_ok=True)
+    report = {'version': cytocad.__version__, 'date': datetime.now().isoformat(timespec='seconds'),
+              'python': platform.python_version(), 'numpy': np.__version__, 'machine': platform.machine(),
+              'cpus': os.cpu_count(), 'threads': args.threads, 'repeat': args.repeat, 'results': {}}
+    for size in args.sizes.split(','):
+        if size not in PRESETS:
+            raise Exception('Error: Benchmark size %s is not one of %s' % (size, ', '.join(PRESETS)))
+        chroms, depth = PRESETS[size]
+        bam = os.path.join(args.data, '%s.rl%d.sd%d.sp%s.su%s.s%d.bam' % (size, args.read_len, args.read_sd,
+                                                                       args.split_rate, args.supp_rate, args.seed))
+        if not os.path.exists(bam + '.json'):
+            print('Simulating %s...' % bam)
+            simulate_bam(bam, chroms, depth, args.read_len, args.read_sd, args.split_rate, args.supp_rate,
+                         seed=args.seed)
+        with open(bam + '.json') as f:
+            info = json.load(f)
+        print('Benchmarking %s (%i reads)...' % (size, info['reads']))
+        report['results'][size] = bench_sample(bam, info, args.repeat, args.threads)
+        for stage in STAGES:
+            s = report['results'][size]['stages'][stage]
+            if s is not None:
+                print('  %-15s %8.3f s %10.1f MB' % (stage, s['wall'], s['peak_mb']))
+        print('  calls %s, planted CNV recall %.3f' % (report['results'][size]['calls_sha1'][:12],
+                                                       report['results'][size]['recall']))
+    report['max_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    with open(args.out, 'w') as f:
+        json.dump(report, f, indent=1)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+
+
+# Run each stage repeat times for its fastest wall and CPU time, then once more under tracemalloc for its peak memory
+def bench_sample(bam, info, repeat, threads):
+    wk_dir = tempfile.mkdtemp(prefix='cytocad_bench_')
+    colors = ['#a6a6a6', '#990000', '#000099']
+    lengths = hg38_sizes()
+    sizes = dict((c, str(lengths[c])) for c in info['chroms'])
+    # Genome size of simulated chromosomes only, so depth matches a whole-genome sample
+    gsize = info['simulated_bases']
+    state = {}
+
+    def parse():
+        state['subdata'], state['basecov'] = bam_parse(bam, threads=threads)
+
+    def probes():
+        state['probe_cov'] = probe_coverage(state['subdata'], 'hg38', 50000, 10)
+
+    def upper():
+        state['upper'] = ovl_upper(gsize, sizes, state['subdata'], wk_dir, False)
+
+    def cad():
+        depth = round(float(state['basecov']) / gsize, 2)
+        state['results'] = cad_sweep(state['subdata'], depth, state['upper'], 'bench', cov_plots=False,
+                                     wk_dir=wk_dir, colors=colors, probe_cov=state['probe_cov'], threads=threads)
+
+    def ideogram():
+        out, tag = state['results'][(500, 0.25)]
+        draw_ideogram(tag, 'bench', wk_dir, 'hg38', 'png')
+
+    stages = {}
+    for name, func in zip(STAGES, (parse, probes, upper, cad, ideogram)):
+        if name == 'ideogram' and not renderer_available():
+            stages[name] = None
+            continue
+        walls, cpus = [], []
+        for _ in range(repeat):
+            wall, cpu = time.perf_counter(), time.process_time()
+            func()
+            walls.append(time.perf_counter() - wall)
+            cpus.append(time.process_time() - cpu)
+        tracemalloc.start()
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        stages[name] = {'wall': min(walls), 'cpu': min(cpus), 'peak_mb': peak / 1024 ** 2}
+    out, tag = state['results'][(500, 0.25)]
+    shutil.rmtree(wk_dir, ignore_errors=True)
+    return {'bam': bam, 'simulation': info, 'stages': stages, 'calls': len(out),
+            'calls_sha1': hashlib.sha1('\n'.join(out).encode()).hexdigest(),
+            'recall': recall(out, info['cnvs']), 'false_bp': false_bases(out, info['cnvs'], info['chroms'])}
+
+
+# Check if an ideogram renderer can run
+def renderer_available():
+    try:
+        check_renderer('auto')
+    except Exception:
+        return False
+    return True
+
+
+# Fraction of planted CNV bases covered by calls of the same direction
+def recall(out, cnvs):
+    total = 0
+    found = 0
+    for chrom, start, end, ratio in cnvs:
+        direction = 'gain' if ratio > 1 else 'loss'
+        total += end - start
+        for line in out:
+            fields = line.split('\t')
+            if fields[0] == chrom and fields[5] == direction:
+                found += max(0, min(end, int(fields[2])) - max(start, int(fields[1])))
+    return found / total if total else 1.0
+
+
+# Bases of calls on simulated chromosomes outside planted CNVs
+def false_bases(out, cnvs, chroms):
+    false_bp = 0
+    for line in out:
+        fields = line.split('\t')
+        if fields[0] not in chroms:
+            continue
+        start, end = int(fields[1]), int(fields[2])
+        inside = sum(max(0, min(end, e) - max(start, s)) for c, s, e, r in cnvs if c == fields[0])
+        false_bp += end - start - inside
+    return false_bp
+
+
+# Print stage time ratios and call changes of a results file against a previous one
+def compare(old, new):
+    print('Comparison with version %s of %s:' % (old['version'], old['date']))
+    for size in new['results']:
+        if size not in old['results']:
+            continue
+        o, n = old['results'][size], new['results'][size]
+        for stage in STAGES:
+            if o['stages'].get(stage) and n['stages'].get(stage):
+                print('  %-7s %-15s %8.3f s -> %8.3f s (x%.2f)  %8.1f MB -> %8.1f MB'
+                      % (size, stage, o['stages'][stage]['wall'], n['stages'][stage]['wall'],
+                         o['stages'][stage]['wall'] / max(n['stages'][stage]['wall'], 1e-9),
+                         o['stages'][stage]['peak_mb'], n['stages'][stage]['peak_mb']))
+        if o['calls_sha1'] != n['calls_sha1']:
+            print('  %-7s CALLS CHANGED: %i -> %i calls, recall %.3f -> %.3f'
+                  % (size, o['calls'], n['calls'], o['recall'], n['recall']))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+"""
+Time the import of CytoCAD entry modules in fresh interpreters, and check which heavy optional libraries they load.
+
+Copyright (C) 2021 Tham Cheng Yong
+
+This file is part of CytoCAD.
+
+CytoCAD is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+CytoCAD is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with CytoCAD.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+from datetime import datetime
+import cytocad
+
+# Modules imported by single sample runs, batch workers and the service, without plots
+CORE = ('cytocad.pipeline', 'cytocad.bam_coverage', 'cytocad.depth_limit', 'cytocad.change_detection',
+        'cytocad.plots', 'cytocad.track', 'cytocad.serve')
+
+# Libraries imported only when plots are rendered, coverage tracks are read or the ruptures segmenter is requested
+OPTIONAL = ('matplotlib.pyplot', 'pandas', 'ruptures')
+
+# Libraries that the core modules should not load
+HEAVY = ('matplotlib', 'pandas', 'scipy', 'ruptures', 'tagore', 'cairosvg')
+
+PROBE = """import sys, time
+t = time.perf_counter()
+import %s
+t = time.perf_counter() - t
+print(t, ' '.join(m for m in %r if m in sys.modules))"""
+
+
+# Parse input
+def startup_parser(args=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description="Benchmark import time of CytoCAD modules.",
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("-o", "--out", type=str, metavar="path",
+                        default='startup.json',
+                        help="machine-readable results file [startup.json]")
+    parser.add_argument("-c", "--compare", type=str, metavar="path",
+                        default=None,
+                        help="results file of a previous version to compare with")
+    parser.add_argument("-r", "--repeat", type=int, metavar="int",
+                        default=5,
+                        help="fresh interpreters per module, the fastest is kept [5]")
+    return parser.parse_args(args)
+
+
+def main():
+    args = startup_parser()
+    report = {'version': cytocad.__version__, 'date': datetime.now().isoformat(timespec='seconds'),
+              'python': platform.python_version(), 'machine': platform.machine(), 'repeat': args.repeat,
+              'results': {}}
+    for module in CORE + OPTIONAL:
+        report['results'][module] = time_import(module, args.repeat)
+        r = report['results'][module]
+        print('  %-26s %8.3f s  %s' % (module, r['wall'], ', '.join(r['heavy']) or '-'))
+    report['results']['cli'] = time_cli(args.repeat)
+    print('  %-26s %8.3f s' % ('cytocad -h', report['results']['cli']['wall']))
+    with open(args.out, 'w') as f:
+        json.dump(report, f, indent=1)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+    loaded = [m for m in CORE if report['results'][m]['heavy']]
+    if loaded:
+        print('Core modules load heavy libraries: %s' % ', '.join(loaded))
+        sys.exit(1)
+
+
+# Fastest import time of a module in fresh interpreters, with the heavy libraries it loads
+def time_import(module, repeat):
+    walls = []
+    heavy = []
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, '-c', PROBE % (module, HEAVY)], check=True, stdout=subprocess.PIPE,
+                             universal_newlines=True).stdout.split()
+        walls.append(float(out[0]))
+        heavy = out[1:]
+    return {'wall': min(walls), 'heavy': heavy}
+
+
+# Fastest wall time of the help message of the command line, including interpreter startup
+def time_cli(repeat):
+    script = os.path.join(os.path.dirname(cytocad.__file__), 'cytocad')
+    walls = []
+    for _ in range(repeat):
+        wall = time.perf_counter()
+        subprocess.run([sys.executable, script, '-h'], check=True, stdout=subprocess.DEVNULL)
+        walls.append(time.perf_counter() - wall)
+    return {'wall': min(walls)}
+
+
+# Print import time ratios of a results file against a previous one
+def compare(old, new):
+    print('Comparison with version %s of %s:' % (old['version'], old['date']))
+    for module in new['results']:
+        if module not in old['results']:
+            continue
+        o, n = old['results'][module]['wall'], new['results'][module]['wall']
+        print('  %-26s %8.3f s -> %8.3f s (x%.2f)' % (module, o, n, o / max(n, 1e-9)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+"""
+Generate synthetic coordinate-sorted BAM files with planted copy-number variations for benchmarks.
+
+Copyright (C) 2021 Tham Cheng Yong
+
+This file is part of CytoCAD.
+
+CytoCAD is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+CytoCAD is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with CytoCAD.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+import os
+import json
+import pysam
+import numpy as np
+import cytocad
+
+
+# Planted CNVs as (chromosome, start, end, copy ratio), placed on chromosomes of every preset
+PLANTED = [('chr19', 20000000, 35000000, 1.5),
+           ('chr20', 5000000, 25000000, 0.5),
+           ('chr21', 15000000, 30000000, 2.0),
+           ('chr22', 20000000, 35000000, 0.0)]
+
+# Benchmark presets of simulated chromosomes and depth
+SUBSET = ('chr19', 'chr20', 'chr21', 'chr22', 'chrX')
+PRESETS = {'chr1x': (SUBSET, 1.0),
+           'chr10x': (SUBSET, 10.0),
+           'wgs1x': (None, 1.0),
+           'wgs10x': (None, 10.0)}
+
+
+# Chromosome sizes of hg38 main chromosomes
+def hg38_sizes():
+    sizes = {}
+    with open(os.path.join(os.path.dirname(cytocad.__file__), 'data', 'hg38_sizes_main.bed')) as f:
+        for line in f:
+            chrm, start, end = line.split('\t')
+            sizes[chrm] = int(end)
+    return sizes
+
+
+# Write a synthetic BAM file with its index and a JSON description of the simulation
+def simulate_bam(path, chroms=None, depth=1.0, read_len=8000, read_sd=6000, split_rate=0.05, supp_rate=0.8,
+                 cnvs=PLANTED, seed=3):
+    rng = np.random.default_rng(seed)
+    sizes = hg38_sizes()
+    contigs = list(sizes)
+    if chroms is None:
+        chroms = [c for c in contigs if c != 'chrY']  # Female sample
+    cnvs = [cnv for cnv in cnvs if cnv[0] in chroms]
+    header = {'HD': {'VN': '1.6', 'SO': 'coordinate'}, 'SQ': [{'SN': c, 'LN': sizes[c]} for c in contigs]}
+    nreads = 0
+    nsplit = 0
+    with pysam.AlignmentFile(path, 'wb', header=header) as bam:
+        for chrom in contigs:
+            if chrom not in chroms:
+                continue
+            starts, lens = place_reads(rng, sizes[chrom], depth, read_len, read_sd,
+                                       [cnv[1:] for cnv in cnvs if cnv[0] == chrom])
+            records = chromosome_records(rng, chrom, contigs.index(chrom), sizes[chrom], starts, lens, split_rate,
+                                         supp_rate, nreads)
+            for pos, segment in sorted(records, key=lambda r: r[0]):
+                bam.write(segment)
+            nreads += len(starts)
+            nsplit += sum(1 for r in records if r[1].flag & 0x900)
+    pysam.index(path)
+    info = {'chroms': list(chroms), 'depth': depth, 'read_len': read_len, 'read_sd': read_sd,
+            'split_rate': split_rate, 'supp_rate': supp_rate, 'seed': seed, 'reads': nreads,
+            'split_reads': nsplit, 'cnvs': cnvs, 'simulated_bases': sum(sizes[c] for c in chroms)}
+    with open(path + '.json', 'w') as f:
+        json.dump(info, f)
+    return info
+
+
+# Draw read starts and lengths of a chromosome, thinning or adding reads inside planted CNVs
+def place_reads(rng, size, depth, read_len, read_sd, cnvs):
+    # Lognormal read lengths with mean read_len and standard deviation read_sd
+    sigma2 = np.log(1 + (read_sd / read_len) ** 2)
+    mu = np.log(read_len) - sigma2 / 2
+    n = rng.poisson(depth * size / read_len)
+    starts = rng.integers(0, size - read_len, size=n)
+    keep = np.ones(n, dtype=bool)
+    extra = []
+    for start, end, ratio in cnvs:
+        inside = (starts >= start) & (starts < end)
+        if ratio < 1:
+            keep &= ~inside | (rng.random(n) < ratio)
+        elif ratio > 1:
+            extra.append(rng.integers(start, end, size=rng.poisson((ratio - 1) * depth * (end - start) / read_len)))
+    starts = np.sort(np.concatenate([starts[keep]] + extra))
+    lens = np.clip(rng.lognormal(mu, np.sqrt(sigma2), size=len(starts)).astype(np.int64), 500, 200000)
+    lens = np.minimum(lens, size - starts)
+    return starts, lens
+
+
+# Make alignments of a chromosome, with split reads given a supplementary or secondary alignment elsewhere on it
+def chromosome_records(rng, chrom, rid, size, starts, lens, split_rate, supp_rate, offset):
+    records = []
+    split = rng.random(len(starts)) < split_rate
+    strands = rng.random(len(starts)) < 0.5
+    for i in range(len(starts)):
+        name = 'read%d' % (offset + i)
+        pos, length, flag = int(starts[i]), int(lens[i]), 16 if strands[i] else 0
+        if not split[i]:
+            records.append((pos, alignment(name, rid, pos, '%dM' % length, flag)))
+            continue
+        # Primary keeps the first part of the read, the rest aligns elsewhere on the chromosome
+        first = int(length * rng.uniform(0.3, 0.7))
+        rest = length - first
+        pos2 = int(rng.integers(0, size - rest))
+        flag2 = flag | (0x800 if rng.random() < supp_rate else 0x100)
+        strand = '-' if flag else '+'
+        sa1 = '%s,%d,%s,%dS%dM,60,0;' % (chrom, pos2 + 1, strand, first, rest)
+        sa2 = '%s,%d,%s,%dM%dS,60,0;' % (chrom, pos + 1, strand, first, rest)
+        records.append((pos, alignment(name, rid, pos, '%dM%dS' % (first, rest), flag, sa1)))
+        records.append((pos2, alignment(name, rid, pos2, '%dH%dM' % (first, rest), flag2, sa2)))
+    return records
+
+
+# Make one alignment without sequence
+def alignment(name, rid, pos, cigar, flag, sa=None):
+    seg = pysam.AlignedSegment()
+    seg.query_name = name
+    seg.flag = flag
+    seg.reference_id = rid
+    seg.reference_start = pos
+    seg.mapping_quality = 60
+    seg.cigarstring = cigar
+    aligned = seg.query_alignment_length
+    tags = [('NM', aligned // 100), ('AS', aligned)]
+    if sa is not None:
+        tags.append(('SA', sa))
+    seg.tags = tags
+    return seg
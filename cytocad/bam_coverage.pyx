@@ -19,113 +19,567 @@ You should have received a copy of the GNU General Public License
 along with CytoCAD.  If not, see <https://www.gnu.org/licenses/>.
 """
 
+cimport cython
+from libc.stdlib cimport qsort
+from libc.string cimport memmove
+from cpython.mem cimport PyMem_Malloc, PyMem_Free
 import pysam
+import re
 import logging
+import numpy as np
+from array import array
+from multiprocessing import Pool
+from cytocad.intervals import AlignmentTable
 
 
-def bam_parse(bam, unsigned int minlen=25, float splitpct=0.05, unsigned int minalign=200):
+# Maximum number of segments resolved per read, segments of lowest priority beyond it are dropped
+cdef unsigned int MAX_ENTRIES = 2000
+
+
+# Aligned segment of a split or clipped read, with query coordinates of the read in forward direction
+cdef struct Entry:
+    int contig  # Index in contig list of the read
+    long long substart, substretch, qstart, qstretch
+    bint minus
+    int priority
+    long long score
+    int order
+
+
+def bam_parse(bam, unsigned int minlen=25, float splitpct=0.05, unsigned int minalign=200, int threads=1,
+              dict stats=None, double target_depth=0, unsigned long long gsize=0):
     cdef:
-        unsigned int readlen, rstart, rend, flag, qlen, nm
-        unsigned long long basecov
         float ovlt
-        int total_score
-        str qname
-        str rname
-        list qseg, sseg, del_list, ins_list, cigar_tup, total_subdata, total_lines, contig_collect
-        bint adv
-        object seg
+        double fraction = 1.0
+        object solo, multi
+        list rows
         int save = pysam.set_verbosity(0)  # Suppress BAM index missing warning
         object sam = pysam.AlignmentFile(bam, "rb")
-        dict repeat_dict = {}
-        dict main_dict = {}
     pysam.set_verbosity(save)  # Revert verbosity level
     ovlt = 0.9  # Set overlap tolerance
-    basecov = 0
-    for seg in sam:
-        flag = seg.flag
-        qname = seg.query_name
-        if flag == 4:
-            continue
-        rname = seg.reference_name
-        readlen = seg.infer_read_length()
-        rstart = seg.reference_start
-        rend = seg.reference_end
-        qlen = seg.query_alignment_length
-        nm = seg.get_tag('NM')
-        total_score = seg.get_tag('AS')
-        cigar_tup = seg.cigartuples
-        adv, qseg, sseg, del_list, ins_list = read_cigar(cigar_tup, minlen, splitpct, rstart, rend, readlen)
+    if target_depth > 0:
+        fraction = subsample_fraction(sam, target_depth, gsize)
+        if stats is not None:
+            stats['sampled_fraction'] = fraction
+    if threads > 1:
+        if sam.has_index():
+            regions = bam_regions(sam, threads)
+            sam.close()
+            return parallel_parse(bam, regions, threads, minlen, splitpct, minalign, ovlt, stats, fraction)
+        logging.warning("Warning: BAM index not found, parsing %s with a single process" % bam)
+    solo, multi = collect_alignments(sam.fetch(until_eof=True), 0, minlen, splitpct, minalign, ovlt,
+                                     fraction=fraction)
+    sam.close()
+    rows = [split_rows(solo, multi)]
+    if len(rows[0]):
+        group_alignments(multi, recover_region((bam, 0, None, minlen, splitpct, fraction, solo.orders(rows[0]))))
+    groups = group_reads(multi)
+    multi = None
+    parse_stats(stats, [solo], rows, groups, minalign)
+    return merge_reads([solo], rows, reduce_groups((groups, minalign, ovlt)))
+
+
+# Subdata entries of reads with no other alignments, resolved as the reads are parsed, in compact columns. Each read
+# keeps its BAM record order and name, and each entry the index of its read.
+cdef class ReducedReads:
+    cdef public list qnames, contigs
+    cdef public dict contig_ids
+    cdef public object order, contig, starts, ends, read
+
+    def __init__(self):
+        self.qnames = []
+        self.contigs = []
+        self.contig_ids = {}
+        self.order = array('Q')
+        self.contig = array('i')
+        self.starts = array('I')
+        self.ends = array('I')
+        self.read = array('I')
+
+    def __len__(self):
+        return len(self.qnames)
+
+    def __reduce__(self):
+        return (rebuild_reads, (self.qnames, self.contigs, self.order, self.contig, self.starts, self.ends, self.read))
+
+    # Resolve an alignment in the form returned by parse_alignment as a read with no other alignments
+    def add(self, unsigned long long order, tuple aln, unsigned int minalign, float ovlt):
+        cdef:
+            unsigned int read = len(self.qnames)
+            list lines
+            tuple line
+        self.order.append(order)
+        self.qnames.append(aln[1])
+        if not aln[0]:  # if no sub-segments and not clipped read
+            self.add_entry(aln[2], aln[3], aln[4], read)
+            return
+        lines = reduce_read([aln], minalign, ovlt)[0]
+        for line in lines:
+            self.add_entry(line[0], line[1], line[1] + line[2], read)
+
+    # Append a subdata entry of the read at index read
+    cdef inline add_entry(self, str rname, unsigned int start, unsigned int end, unsigned int read):
         try:
-            main_dict[qname].append((adv, qname, rname, rstart, rend, readlen, qlen, flag, nm, total_score, qseg, sseg, del_list,
-            ins_list))
+            self.contig.append(self.contig_ids[rname])
         except KeyError:
-            main_dict[qname] = []
-            main_dict[qname].append((adv, qname, rname, rstart, rend, readlen, qlen, flag, nm, total_score, qseg, sseg, del_list,
-            ins_list))
-    total_subdata, total_lines, contig_collect = [], [], []
-    for qname in main_dict:
-        if len(main_dict[qname]) == 1:  # Single alignment read
-            if not main_dict[qname][0][0]:  # if no sub-segments and not clipped read
-                aln = main_dict[qname][0]
-                qname = aln[1]
-                rname = aln[2]
-                rstart = aln[3]
-                rend = aln[4]
-                total_subdata.append(info_parse_simple(qname, rname, rstart, rend, minalign))
-                # Add to base coverage
-                basecov += rend - rstart
-            else:  # if multiple sub-segments or clipped read
-                aln = main_dict[qname][0]
-                qname = aln[1]
-                rname = aln[2]
-                readlen = aln[5]
-                qlen = aln[6]
-                flag = aln[7]
-                nm = aln[8]
-                total_score = aln[9]
-                qseg = aln[10]
-                sseg = aln[11]
-                del_list = aln[12]
-                ins_list = aln[13]
-                total_lines, contig_collect = info_parse(qname, rname, readlen, qlen, flag, nm, total_score, qseg, sseg,
-                del_list, ins_list, minalign)
-                lines_sort = sorted(sorted(total_lines, key=lambda x: x[1], reverse=True), key=lambda y: y[0])
-                temp1 = [tup[2] for tup in lines_sort]
-                # Parse entries and correct overlap alignments
-                subdata = entry_parser(temp1, contig_collect, ovlt)
-                for entry in subdata:
-                    total_subdata.append('\t'.join(entry.split('\t')[0:5]))
-                    # Add to base coverage
-                    basecov += int(entry.split('\t')[2])
-        else:  # Multiple alignment read
-            total_lines = []
-            contig_collect = []
-            for aln in main_dict[qname]:
-                qname = aln[1]
-                rname = aln[2]
-                readlen = aln[5]
-                qlen = aln[6]
-                flag = aln[7]
-                nm = aln[8]
-                total_score = aln[9]
-                qseg = aln[10]
-                sseg = aln[11]
-                del_list = aln[12]
-                ins_list = aln[13]
-                lines, contigs = info_parse(qname, rname, readlen, qlen, flag, nm, total_score, qseg, sseg,
-                del_list, ins_list, minalign)
-                total_lines.extend(lines)
-                contig_collect.extend(contigs)
-            contig_collect = sorted(set(contig_collect))
-            lines_sort = sorted(sorted(total_lines, key=lambda x: x[1], reverse=True), key=lambda y: y[0])
-            temp1 = [tup[2] for tup in lines_sort]
-            # Parse entries and correct overlap alignments
-            subdata = entry_parser(temp1, contig_collect, ovlt)
-            for entry in subdata:
-                total_subdata.append('\t'.join(entry.split('\t')[0:5]))
-                # Add to base coverage
-                basecov += int(entry.split('\t')[2])
-    return total_subdata, basecov
+            self.contig_ids[rname] = len(self.contigs)
+            self.contig.append(len(self.contigs))
+            self.contigs.append(rname)
+        self.starts.append(start)
+        self.ends.append(end)
+        self.read.append(read)
+
+    # BAM record order of reads by index
+    def orders(self, rows):
+        return set(np.asarray(self.order)[rows].tolist())
+
+
+def rebuild_reads(qnames, contigs, *columns):
+    cdef ReducedReads solo = ReducedReads()
+    solo.qnames = qnames
+    solo.contigs = contigs
+    solo.contig_ids = {contigs[i]: i for i in range(len(contigs))}
+    solo.order, solo.contig, solo.starts, solo.ends, solo.read = columns
+    return solo
+
+
+# Fraction of reads to keep for a target depth, estimated from the BAM index
+def subsample_fraction(sam, double target_depth, unsigned long long gsize=0, unsigned int nsample=1000):
+    cdef double depth
+    if not sam.has_index():
+        logging.warning("Warning: BAM index not found, target depth is ignored and all reads are parsed")
+        return 1.0
+    depth = estimate_depth(sam, gsize, nsample)
+    if depth <= target_depth:
+        return 1.0
+    return target_depth / depth
+
+
+# Depth of an indexed BAM estimated from mapped record counts of its index and the aligned length of its first records
+def estimate_depth(sam, unsigned long long gsize=0, unsigned int nsample=1000):
+    cdef:
+        unsigned long long mapped = 0
+        unsigned long long span = 0
+        unsigned int n = 0
+    for stat in sam.get_index_statistics():
+        mapped += stat.mapped
+    # Read the first records with a separate file handle, leaving the position of sam at the start
+    for seg in sam.head(nsample):
+        if seg.is_unmapped:
+            continue
+        span += seg.reference_length
+        n += 1
+    if n == 0:
+        return 0.0
+    if gsize == 0:
+        gsize = sum(sam.lengths)
+    return mapped * (<double> span / n) / gsize
+
+
+# Stable 64-bit hash of a read name, FNV-1a with a final bit mixing step
+cdef inline unsigned long long read_hash(str qname):
+    cdef:
+        bytes b = qname.encode()
+        const unsigned char *p = b
+        Py_ssize_t i
+        unsigned long long h = 14695981039346656037ULL
+    for i in range(len(b)):
+        h = (h ^ p[i]) * 1099511628211ULL
+    h = (h ^ (h >> 30)) * 13787848793156543929ULL
+    h = (h ^ (h >> 27)) * 10723151780598845931ULL
+    return h ^ (h >> 31)
+
+
+# BAM records kept for parsing, with their record order. Reads are kept by a hash of their name when fraction is
+# below 1, so all alignments of a read are kept or dropped.
+def kept_records(records, unsigned long long order, long start=-1, double fraction=1.0):
+    cdef:
+        object seg
+        bint sample = fraction < 1
+        unsigned long long threshold = <unsigned long long> (fraction * 18446744073709551616.0) if sample else 0
+    for seg in records:
+        if seg.flag == 4 or seg.reference_start < start:  # Reads starting before region belong to the previous one
+            continue
+        if sample and read_hash(seg.query_name) >= threshold:
+            continue
+        yield order, seg
+        order += 1
+
+
+# Whether the aligned segment of a BAM record is kept once its read is resolved, judged from the record alone. Unmapped
+# records are skipped as in kept_records, and primary and supplementary alignments lead the resolution. Secondary
+# alignments are resolved last, so one is kept only if its SA tag shows no other alignment of the read covering its part
+# of the query by more than ovlt, as a secondary with no SA tag aligns the same part of the read as its primary.
+def resolved_record(seg, float ovlt=0.9):
+    cdef:
+        long long readlen, qstart, qend, leadstart, leadend, qulen, leadintlen
+        str entry
+    if seg.flag == 4:
+        return False
+    if not seg.is_secondary:
+        return True
+    if not seg.has_tag('SA'):
+        return False
+    readlen = seg.infer_read_length()
+    qstart, qend = query_range(seg.cigarstring, seg.is_reverse, readlen)
+    qulen = qend - qstart + 1
+    for entry in seg.get_tag('SA').rstrip(';').split(';'):
+        fields = entry.split(',')
+        leadstart, leadend = query_range(fields[3], fields[2] == '-', readlen)
+        leadintlen = min(leadend, qend) - max(leadstart, qstart) + 1
+        if leadintlen > 0 and (<double> leadintlen / qulen > ovlt or (qulen - leadintlen) <= 50):
+            return False
+    return True
+
+
+# Query range of an alignment in forward read direction from its CIGAR string
+cdef tuple query_range(str cigar, bint minus, long long readlen):
+    cdef:
+        long long clip = 0, qlen = 0
+        bint lead = True
+        str n, t
+    for n, t in re.findall(r'(\d+)([MIDNSHP=X])', cigar):
+        if t in 'SH':
+            if lead:
+                clip += int(n)
+        elif t in 'MI=X':
+            lead = False
+            qlen += int(n)
+        else:
+            lead = False
+    if minus:
+        return readlen - clip - qlen, readlen - clip
+    return clip, clip + qlen
+
+
+# Resolve BAM records of reads with no other alignments on the spot, and collect records of reads that may have several
+# alignments into read groups
+def collect_alignments(records, unsigned long long order, unsigned int minlen, float splitpct, unsigned int minalign,
+                       float ovlt, long start=-1, double fraction=1.0):
+    cdef:
+        str qname
+        object seg
+        ReducedReads solo = ReducedReads()
+        dict multi = {}
+    for order, seg in kept_records(records, order, start, fraction):
+        qname = seg.query_name
+        if seg.flag & 0x900 or seg.has_tag('SA') or qname in multi:  # Secondary, supplementary or split alignment
+            try:
+                multi[qname].append((order, parse_alignment(seg, minlen, splitpct)))
+            except KeyError:
+                multi[qname] = [(order, parse_alignment(seg, minlen, splitpct))]
+        else:
+            solo.add(order, parse_alignment(seg, minlen, splitpct), minalign, ovlt)
+    return solo, multi
+
+
+# Indices of resolved reads that turned out to be split. A primary alignment with secondary alignments elsewhere in the
+# BAM is resolved before its read is known to be split.
+def split_rows(ReducedReads solo, dict multi):
+    return np.array([i for i in range(len(solo)) if solo.qnames[i] in multi], dtype=np.intp)
+
+
+# Parse the kept BAM records of a region, or of the whole BAM, that have the given record orders
+def recover_region(tuple job):
+    cdef:
+        list found = []
+        object sam
+        int save
+    bam, index, region, minlen, splitpct, fraction, wanted = job
+    save = pysam.set_verbosity(0)
+    sam = pysam.AlignmentFile(bam, "rb")
+    pysam.set_verbosity(save)
+    if region is None:
+        records = kept_records(sam.fetch(until_eof=True), 0, -1, fraction)
+    else:
+        records = kept_records(sam.fetch(region[0], region[1], region[2]), <unsigned long long>index << 40, region[1],
+                               fraction)
+    for order, seg in records:
+        if order in wanted:
+            found.append((order, parse_alignment(seg, minlen, splitpct)))
+            if len(found) == len(wanted):
+                break
+    sam.close()
+    return found
+
+
+# Add recovered alignments of split reads to their read groups
+def group_alignments(dict multi, list found):
+    for order, aln in found:
+        multi[aln[1]].append((order, aln))
+
+
+# Order the alignments of each read group and the groups by first BAM record
+def group_reads(dict multi):
+    cdef list groups = []
+    for qname in multi:
+        multi[qname].sort(key=lambda x: x[0])
+        groups.append((multi[qname][0][0], [aln for order, aln in multi[qname]]))
+    groups.sort(key=lambda x: x[0])
+    return groups
+
+
+# Count parsed alignment records, reads, split reads, segments of the largest split read and split reads over the
+# segment cap into stats
+def parse_stats(dict stats, list solos, list rows, list groups, unsigned int minalign):
+    cdef:
+        unsigned int nseg, maxseg = 0, capped = 0
+        unsigned long long nsolo
+        tuple aln
+    if stats is None:
+        return
+    for order, alns in groups:
+        nseg = 0
+        for aln in alns:
+            for seg in aln[11]:
+                if seg[1] - seg[0] >= minalign:
+                    nseg += 1
+        maxseg = max(maxseg, nseg)
+        if nseg > MAX_ENTRIES:
+            capped += 1
+    nsolo = sum(len(solo) for solo in solos) - sum(len(r) for r in rows)
+    stats['records'] = nsolo + sum(len(alns) for order, alns in groups)
+    stats['reads'] = nsolo + len(groups)
+    stats['split_reads'] = len(groups)
+    stats['max_read_segments'] = maxseg
+    stats['capped_reads'] = capped
+
+
+# Resolve each read of a stream of alignments grouped by read name, such as aligner output, as soon as the next read
+# name appears. Yields subdata entries and base coverage of each read, holding only one read in memory.
+def stream_reads(records, unsigned int minlen=25, float splitpct=0.05, unsigned int minalign=200, dict stats=None):
+    cdef:
+        float ovlt = 0.9
+        str qname
+        str current = None
+        list alns = []
+        object seg
+        unsigned long long nrecords = 0, nreads = 0, nsplit = 0
+    for seg in records:
+        if seg.flag & 4:
+            continue
+        qname = seg.query_name
+        if qname != current:
+            if alns:
+                nreads += 1
+                nsplit += len(alns) > 1
+                yield reduce_read(alns, minalign, ovlt)
+            alns = []
+            current = qname
+        alns.append(parse_alignment(seg, minlen, splitpct))
+        nrecords += 1
+    if alns:
+        nreads += 1
+        nsplit += len(alns) > 1
+        yield reduce_read(alns, minalign, ovlt)
+    if stats is not None:
+        stats['records'] = nrecords
+        stats['reads'] = nreads
+        stats['split_reads'] = nsplit
+
+
+# Merge subdata entries of resolved reads, leaving out rows of split reads, with those of resolved read groups in BAM
+# record order. Returns them as an AlignmentTable with their base coverage.
+def merge_reads(list solos, list rows, list groups_reduced):
+    cdef:
+        list contigs = []
+        dict contig_ids = {}
+        list qnames = []
+        list parts = []
+        list gcontig = [], gstart = [], gend = [], gread = [], gorder = []
+        unsigned int k
+        ReducedReads solo
+    for k in range(len(solos)):
+        solo = solos[k]
+        ids = np.array([contig_ids.setdefault(c, len(contig_ids)) for c in solo.contigs], dtype=np.int32)
+        read = np.asarray(solo.read)
+        keep = np.ones(len(solo), dtype=bool)
+        keep[rows[k]] = False
+        keep = keep[read]
+        parts.append((np.asarray(solo.order)[read][keep], ids[np.asarray(solo.contig)[keep]],
+                      np.asarray(solo.starts)[keep], np.asarray(solo.ends)[keep],
+                      read[keep].astype(np.int64) + len(qnames)))
+        qnames.extend(solo.qnames)
+    for order, lines, cov in groups_reduced:
+        for line in lines:
+            gcontig.append(contig_ids.setdefault(line[0], len(contig_ids)))
+            gstart.append(line[1])
+            gend.append(line[1] + line[2])
+            gread.append(len(qnames))
+            gorder.append(order)
+        if lines:
+            qnames.append(lines[0][3])
+    parts.append((np.array(gorder, dtype=np.uint64), np.array(gcontig, dtype=np.int32), np.array(gstart, dtype=np.int64),
+                  np.array(gend, dtype=np.int64), np.array(gread, dtype=np.int64)))
+    order, contig, starts, ends, read = [np.concatenate([part[i] for part in parts]) for i in range(5)]
+    parts = None
+    # Record order is unique to each read, and entries of a read stay in their order
+    merged = np.argsort(order, kind='stable')
+    contig, starts, ends, read = contig[merged], starts[merged].astype(np.int64), ends[merged].astype(np.int64), \
+        read[merged]
+    first = np.diff(read, prepend=-1) != 0
+    readid = np.cumsum(first) - 1
+    qnames = [qnames[i] for i in read[first].tolist()]
+    # Number contigs by their first entry in BAM record order
+    ids, index = np.unique(contig, return_index=True)
+    ids = ids[np.argsort(index)]
+    rank = np.zeros(len(contig_ids), dtype=np.int32)
+    rank[ids] = np.arange(len(ids), dtype=np.int32)
+    contigs = list(contig_ids)
+    contigs = [contigs[i] for i in ids.tolist()]
+    return AlignmentTable(contigs, rank[contig], starts, ends, readid, qnames), int((ends - starts).sum())
+
+
+# Extract alignment fields and CIGAR segments of a BAM record
+cdef tuple parse_alignment(object seg, unsigned int minlen, float splitpct):
+    cdef:
+        unsigned int readlen, rstart, rend, flag, qlen, nm
+        int total_score
+        list qseg, sseg, del_list, ins_list
+        bint adv
+    flag = seg.flag
+    readlen = seg.infer_read_length()
+    rstart = seg.reference_start
+    rend = seg.reference_end
+    qlen = seg.query_alignment_length
+    nm = seg.get_tag('NM')
+    total_score = seg.get_tag('AS')
+    adv, qseg, sseg, del_list, ins_list = read_cigar(seg.cigartuples, minlen, splitpct, rstart, rend, readlen)
+    return (adv, seg.query_name, seg.reference_name, rstart, rend, readlen, qlen, flag, nm, total_score, qseg, sseg,
+            del_list, ins_list)
+
+
+# Resolve all alignments of a read into subdata entries and their base coverage
+def reduce_read(list alns, unsigned int minalign, float ovlt):
+    cdef:
+        unsigned long long cov = 0
+        list lines = []
+        list contigs = []
+        tuple aln
+        Entry *entries
+        int n = 0
+        int nseg = 0
+    if len(alns) == 1:  # Single alignment read
+        aln = alns[0]
+        if not aln[0]:  # if no sub-segments and not clipped read
+            lines.append(info_parse_simple(aln[1], aln[2], aln[3], aln[4], minalign))
+            # Add to base coverage
+            cov += aln[4] - aln[3]
+            return lines, cov
+    # Multiple alignment read, or single alignment read with sub-segments or clipping
+    for aln in alns:
+        nseg += len(aln[10])
+    entries = <Entry *> PyMem_Malloc(max(nseg, 1) * sizeof(Entry))
+    if entries is NULL:
+        raise MemoryError()
+    try:
+        for aln in alns:
+            n = info_parse(entries, n, contigs, aln[2], aln[5], aln[6], aln[7], aln[8], aln[9], aln[10], aln[11],
+                           aln[12], aln[13], minalign)
+        # Lead order is by alignment priority, then by score
+        qsort(entries, n, sizeof(Entry), entry_order)
+        if n > MAX_ENTRIES:
+            logging.warning("Warning: Read %s has %i alignment segments, only the %i with highest priority are "
+                            "resolved" % (alns[0][1], n, MAX_ENTRIES))
+            n = MAX_ENTRIES
+        # Parse entries and correct overlap alignments
+        lines = entry_parser(entries, n, contigs, alns[0][1], ovlt)
+    finally:
+        PyMem_Free(entries)
+    for line in lines:
+        # Add to base coverage
+        cov += line[2]
+    return lines, cov
+
+# Split indexed BAM into contig regions of roughly equal size for parallel parsing
+def bam_regions(sam, int threads):
+    cdef:
+        list regions = []
+        dict mapped = {}
+        unsigned long long total = 0
+        unsigned long long step, start, length
+    for stat in sam.get_index_statistics():
+        mapped[stat.contig] = stat.mapped
+    for contig, length in zip(sam.references, sam.lengths):
+        if mapped.get(contig, 0) > 0:
+            total += length
+    step = max(total // (threads * 4), 1000000)
+    for contig, length in zip(sam.references, sam.lengths):
+        if mapped.get(contig, 0) == 0:
+            continue
+        start = 0
+        while start < length:
+            regions.append((contig, start, min(start + step, length)))
+            start += step
+    return regions
+
+
+# Parse BAM regions in a process pool and group alignments of reads spanning several regions
+def parallel_parse(bam, list regions, int threads, unsigned int minlen, float splitpct, unsigned int minalign,
+                   float ovlt, dict stats=None, double fraction=1.0):
+    cdef:
+        list solos = []
+        list rows
+        list groups_reduced = []
+        list groups, chunks, jobs
+        dict multi = {}
+        int i
+    jobs = [(bam, i, regions[i], minlen, splitpct, minalign, ovlt, fraction) for i in range(len(regions))]
+    with Pool(threads) as pool:
+        for shard_solo, shard_multi in pool.imap(parse_region, jobs):
+            solos.append(shard_solo)
+            # Merge alignments of the same read found in different regions
+            for qname in shard_multi:
+                try:
+                    multi[qname].extend(shard_multi[qname])
+                except KeyError:
+                    multi[qname] = shard_multi[qname]
+        rows = [split_rows(solo, multi) for solo in solos]
+        jobs = [(bam, i, regions[i], minlen, splitpct, fraction, solos[i].orders(rows[i])) for i in range(len(regions))
+                if len(rows[i])]
+        for found in pool.imap(recover_region, jobs):
+            group_alignments(multi, found)
+        groups = group_reads(multi)
+        multi = None
+        parse_stats(stats, solos, rows, groups, minalign)
+        chunks = [(groups[i:i + 5000], minalign, ovlt) for i in range(0, len(groups), 5000)]
+        groups = None
+        for reduced in pool.imap(reduce_groups, chunks):
+            groups_reduced.extend(reduced)
+    return merge_reads(solos, rows, groups_reduced)
+
+
+# Parse a single BAM region, resolving reads with no other alignments as they are read
+def parse_region(tuple job):
+    cdef:
+        unsigned int minlen, minalign
+        float splitpct, ovlt
+        double fraction
+        object sam
+        int save
+    bam, index, region, minlen, splitpct, minalign, ovlt, fraction = job
+    save = pysam.set_verbosity(0)
+    sam = pysam.AlignmentFile(bam, "rb")
+    pysam.set_verbosity(save)
+    # Region index as high bits keeps record order global
+    solo, multi = collect_alignments(sam.fetch(region[0], region[1], region[2]), <unsigned long long>index << 40,
+                                     minlen, splitpct, minalign, ovlt, region[1], fraction)
+    sam.close()
+    return solo, multi
+
+
+# Reduce a chunk of grouped multi-alignment reads
+def reduce_groups(tuple job):
+    cdef:
+        list reduced = []
+        unsigned long long cov
+        unsigned int minalign
+        float ovlt
+    groups, minalign, ovlt = job
+    for order, alns in groups:
+        lines, cov = reduce_read(alns, minalign, ovlt)
+        reduced.append((order, lines, cov))
+    return reduced
 
 
 # Analyze CIGAR for Indels in segment and return read advancement call
@@ -200,139 +654,178 @@ cdef read_cigar(list cigar_tup, float minlen, float splitpct, unsigned int rstar
         return True, qseg, sseg, del_list, ins_list
 
 
-def info_parse(qname, rname, readlen, qlen, flag, nm, total_score, qseg, sseg, del_list, ins_list, minlen=200):
-    lines = []
-    total_del = sum([x for x in del_list])
-    total_ins = sum([x for x in ins_list])
-    total_gap = total_del + total_ins
-    total_mismatch = nm - total_gap
-    nsegs = len(qseg)
-    contig_collect = []
-    for i in range(nsegs):
-        substart = sseg[i][0]
+# Add segments of an alignment at least minlen long as entries from index n, and return the new number of entries
+cdef int info_parse(Entry *entries, int n, list contigs, str rname, long long readlen, long long qlen, unsigned int flag,
+                    long long nm, long long total_score, list qseg, list sseg, list del_list, list ins_list,
+                    unsigned int minlen=200) except -1:
+    cdef:
+        int i, contig
+        long long substretch, qstart, qstretch
+        bint minus
+    try:
+        contig = contigs.index(rname)
+    except ValueError:
+        contig = len(contigs)
+        contigs.append(rname)
+    for i in range(len(qseg)):
         substretch = sseg[i][1] - sseg[i][0]
         if substretch < minlen:
             continue
-        qstart, qstretch, strand = query_sign(qseg[i][0], qseg[i][1], flag, readlen)
-        ndel = del_list[i]
-        nins = ins_list[i]
-        gaps = ndel + nins
-        subratio = round(qstretch / qlen, 3)
-        mismatch = int(round(total_mismatch * subratio, 0))
-        matches = max(qstretch - mismatch - nins, 1)
-        pident = min(round(matches * 100 / substretch, 2), 100.00)
-        score = int(round(total_score * subratio, 0))
-        priority = align_priority(flag)
-        line = "%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s" % (rname, substart, substretch, '+',
-                                                                           qname, qstart, qstretch, strand,
-                                                                           readlen, 0.0, score, pident, mismatch, gaps)
-        contig_collect.append(rname)
-        lines.append((priority, score, line))
-    return lines, contig_collect
+        qstart, qstretch, minus = query_sign(qseg[i][0], qseg[i][1], flag, readlen)
+        entries[n].contig = contig
+        entries[n].substart = sseg[i][0]
+        entries[n].substretch = substretch
+        entries[n].qstart = qstart
+        entries[n].qstretch = qstretch
+        entries[n].minus = minus
+        entries[n].priority = align_priority(flag)
+        # Python rounding of the score share keeps lead order of equal priority alignments
+        entries[n].score = int(round(total_score * round(<double> qstretch / qlen, 3), 0))
+        entries[n].order = n
+        n += 1
+    return n
+
 
 # Parse segments without breakends
 def info_parse_simple(qname, rname, substart, rend, minlen=200):
     substretch = rend - substart
     if substretch < minlen:
         pass
-    line = "%s\t%s\t%s\t%s\t%s" % (rname, substart, substretch, '+', qname)
-    return line
-
-# Parse query start and end values according to read direction
-def query_sign(start, end, flag, readlen):
-    if flag in (0, 2048, 256):
-        return start, end - start, '+'
-    elif flag in (16, 2064, 272):
-        return readlen - end, end - start, '-'
+    return rname, substart, substretch, qname
+
+# Parse query start and length according to read direction, and whether the read is reversed
+cdef inline tuple query_sign(long long start, long long end, unsigned int flag, long long readlen):
+    if flag == 16 or flag == 2064 or flag == 272:
+        return readlen - end, end - start, True
     else:
-        return start, end - start, '+'
+        return start, end - start, False
+
 
 # Set alignment priority according to flag
-def align_priority(flag):
-    if flag in (0, 16):
+cdef inline int align_priority(unsigned int flag):
+    if flag == 0 or flag == 16:
         return 1
-    elif flag in (2048, 2064):
+    elif flag == 2048 or flag == 2064:
         return 2
     else:
         return 3
 
 
-# Parse alignment entries
-def entry_parser(temp1, chromocollect, overlap_tol):
-    temp2 = []
-    num_chr = len(chromocollect)  # Total number of chromosomes aligned
-    num_align = len(temp1)  # Total number of alignments
-    while len(temp1) != 0:
-        # Lock-in lead alignment with the highest bitscore
-        temp2.append(temp1[0] + '\tn=' + str(num_align) + '\t' + str(num_chr) + 'chr')
-        # leadrange = [int(temp1[0].split('\t')[5]), int(temp1[0].split('\t')[5]) + int(temp1[0].split('\t')[6])]
-        leadstart = int(temp1[0].split('\t')[5])
-        leadend = int(temp1[0].split('\t')[5]) + int(temp1[0].split('\t')[6])
-        del temp1[0]  # Remove lead alignment entry
-        j = len(temp1)  # Recalculate number of remaining entries
-        temp3 = []
-        for p in range(j):
-            qstart = int(temp1[p].split('\t')[5])
-            qend = int(temp1[p].split('\t')[5]) + int(temp1[p].split('\t')[6])
-            queryrange = range(qstart, qend + 1)
-            leadintersect = range(max(leadstart, qstart), min(leadend, qend) + 1)
-            if len(leadintersect) == 0:  # No intersection with lead
-                temp3.append(temp1[p])
-            else:
-                qulen = len(queryrange)
-                leadintlen = len(leadintersect)
-                if float(leadintlen) / qulen > overlap_tol or (qulen - leadintlen) <= 50:
+# Order entries by priority, then by decreasing score, then by parsing order
+cdef int entry_order(const void *a, const void *b) nogil:
+    cdef const Entry *x = <const Entry *> a
+    cdef const Entry *y = <const Entry *> b
+    if x.priority != y.priority:
+        return -1 if x.priority < y.priority else 1
+    if x.score != y.score:
+        return -1 if x.score > y.score else 1
+    return -1 if x.order < y.order else (1 if x.order > y.order else 0)
+
+
+# Resolve entries sorted in lead order into non-overlapping subdata entries ordered by query start. The first
+# remaining entry becomes a lead, and each later entry overlapping it is omitted, or trimmed if the overlap is within
+# overlap_tol of its length and leaves more than 50 bp. Trimmed entries never overlap their lead, so leads are disjoint
+# in query coordinates. Each entry is therefore resolved in turn against only the leads found in its query range by
+# binary search, applied in lead order, rather than every lead updating every later entry.
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef list entry_parser(Entry *e, int n, list contigs, str qname, float overlap_tol):
+    cdef:
+        int i, p, k, lo, hi, nlead = 0, ncand
+        long long leadstart, leadend, qstart, qend, qulen, leadintlen
+        bint alive
+        dict leads = {}
+        # Leads sorted by query start, with their entry index
+        long long *lstart = <long long *> PyMem_Malloc(max(n, 1) * sizeof(long long))
+        long long *lend = <long long *> PyMem_Malloc(max(n, 1) * sizeof(long long))
+        int *lidx = <int *> PyMem_Malloc(max(n, 1) * sizeof(int))
+        int *cand = <int *> PyMem_Malloc(max(n, 1) * sizeof(int))
+    if lstart is NULL or lend is NULL or lidx is NULL or cand is NULL:
+        PyMem_Free(lstart)
+        PyMem_Free(lend)
+        PyMem_Free(lidx)
+        PyMem_Free(cand)
+        raise MemoryError()
+    try:
+        for p in range(n):
+            qstart = e[p].qstart
+            qend = e[p].qstart + e[p].qstretch
+            # Leads overlapping the untrimmed query range, as trimming only shrinks it
+            lo = 0
+            hi = nlead
+            while lo < hi:
+                k = (lo + hi) // 2
+                if lend[k] < qstart:
+                    lo = k + 1
+                else:
+                    hi = k
+            ncand = 0
+            while lo < nlead and lstart[lo] <= qend:
+                # Insert by entry index to apply leads in the order they were locked in
+                k = ncand
+                while k > 0 and cand[k - 1] > lidx[lo]:
+                    cand[k] = cand[k - 1]
+                    k -= 1
+                cand[k] = lidx[lo]
+                ncand += 1
+                lo += 1
+            alive = True
+            for k in range(ncand):
+                i = cand[k]
+                leadstart = e[i].qstart
+                leadend = e[i].qstart + e[i].qstretch
+                qstart = e[p].qstart
+                qend = e[p].qstart + e[p].qstretch
+                leadintlen = min(leadend, qend) - max(leadstart, qstart) + 1
+                if leadintlen <= 0:  # No intersection with lead
+                    continue
+                qulen = qend - qstart + 1
+                if <double> leadintlen / qulen > overlap_tol or (qulen - leadintlen) <= 50:
                     # If overlap len is more than 90% of query alignment length or
                     # after-trimmed length <=50 bp, lead wins and query is omitted. Otherwise, do trimming.
-                    continue  # Entry omitted
-                else:  # If overlap is tolerated, then do trimming
-                    new = ''
-                    strand = str(temp1[p].split('\t')[7])
-                    # Alter query and subject ranges and adjust bitscore as a proportion of alignment length
-                    if qstart == min(leadintersect):  # Left overlap
-                        if strand == '+':
-                            new = temp1[p].split('\t')[0] + '\t' + str(
-                                int(temp1[p].split('\t')[1]) + leadintlen) + '\t' + str(
-                                int(temp1[p].split('\t')[2]) - leadintlen) + '\t' + '\t'.join(
-                                temp1[p].split('\t')[3:5]) + '\t' + str(
-                                int(temp1[p].split('\t')[5]) + leadintlen) + '\t' + str(
-                                int(temp1[p].split('\t')[6]) - leadintlen) + '\t' + '\t'.join(
-                                temp1[p].split('\t')[7:10]) + '\t' + str(
-                                round(float(temp1[p].split('\t')[10]) * (float(qulen - leadintlen) / qulen),
-                                      2)) + '\t' + '\t'.join(temp1[p].split('\t')[11:])
-                        elif strand == '-':
-                            new = temp1[p].split('\t')[0] + '\t' + temp1[p].split('\t')[1] + '\t' + str(
-                                int(temp1[p].split('\t')[2]) - leadintlen) + '\t' + '\t'.join(
-                                temp1[p].split('\t')[3:5]) + '\t' + str(
-                                int(temp1[p].split('\t')[5]) + leadintlen) + '\t' + str(
-                                int(temp1[p].split('\t')[6]) - leadintlen) + '\t' + '\t'.join(
-                                temp1[p].split('\t')[7:10]) + '\t' + str(
-                                round(float(temp1[p].split('\t')[10]) * (float(qulen - leadintlen) / qulen),
-                                      2)) + '\t' + '\t'.join(temp1[p].split('\t')[11:])
-                    elif qend == max(leadintersect):  # Right overlap
-                        if strand == '+':
-                            new = temp1[p].split('\t')[0] + '\t' + temp1[p].split('\t')[1] + '\t' + str(
-                                int(temp1[p].split('\t')[2]) - leadintlen) + '\t' + '\t'.join(
-                                temp1[p].split('\t')[3:5]) + '\t' + temp1[p].split('\t')[5] + '\t' + str(
-                                int(temp1[p].split('\t')[6]) - leadintlen) + '\t' + '\t'.join(
-                                temp1[p].split('\t')[7:10]) + '\t' + str(
-                                round(float(temp1[p].split('\t')[10]) * (float(qulen - leadintlen) / qulen),
-                                      2)) + '\t' + '\t'.join(temp1[p].split('\t')[11:])
-                        elif strand == '-':
-                            new = temp1[p].split('\t')[0] + '\t' + str(
-                                int(temp1[p].split('\t')[1]) + leadintlen) + '\t' + str(
-                                int(temp1[p].split('\t')[2]) - leadintlen) + '\t' + '\t'.join(
-                                temp1[p].split('\t')[3:5]) + '\t' + temp1[p].split('\t')[5] + '\t' + str(
-                                int(temp1[p].split('\t')[6]) - leadintlen) + '\t' + '\t'.join(
-                                temp1[p].split('\t')[7:10]) + '\t' + str(
-                                round(float(temp1[p].split('\t')[10]) * (float(qulen - leadintlen) / qulen),
-                                      2)) + '\t' + '\t'.join(temp1[p].split('\t')[11:])
-                    else:  # If lead lies entirely within intersection, omit entry
-                        continue
-                    if new != '' and int(new.split('\t')[2]) > 0:
-                        temp3.append(new)
-        temp1 = temp3
-    sortdict = {}
-    for k in temp2:
-        sortdict[int(k.split('\t')[5])] = k
-    return [value for (key, value) in sorted(sortdict.items())]
+                    alive = False
+                    break
+                # Alter query and subject ranges
+                if qstart >= leadstart:  # Left overlap
+                    e[p].qstart += leadintlen
+                    if not e[p].minus:
+                        e[p].substart += leadintlen
+                elif qend <= leadend:  # Right overlap
+                    if e[p].minus:
+                        e[p].substart += leadintlen
+                else:  # If lead lies entirely within intersection, omit entry
+                    alive = False
+                    break
+                e[p].qstretch -= leadintlen
+                e[p].substretch -= leadintlen
+                if e[p].substretch <= 0:
+                    alive = False
+                    break
+            if not alive:
+                continue
+            # Lock-in lead alignment, a later lead with the same query start replaces it
+            leads[e[p].qstart] = p
+            if e[p].qstretch < 0:  # Empty query range overlaps nothing
+                continue
+            lo = 0
+            hi = nlead
+            while lo < hi:
+                k = (lo + hi) // 2
+                if lstart[k] < e[p].qstart:
+                    lo = k + 1
+                else:
+                    hi = k
+            memmove(&lstart[lo + 1], &lstart[lo], (nlead - lo) * sizeof(long long))
+            memmove(&lend[lo + 1], &lend[lo], (nlead - lo) * sizeof(long long))
+            memmove(&lidx[lo + 1], &lidx[lo], (nlead - lo) * sizeof(int))
+            lstart[lo] = e[p].qstart
+            lend[lo] = e[p].qstart + e[p].qstretch
+            lidx[lo] = p
+            nlead += 1
+    finally:
+        PyMem_Free(lstart)
+        PyMem_Free(lend)
+        PyMem_Free(lidx)
+        PyMem_Free(cand)
+    return [(contigs[e[i].contig], e[i].substart, e[i].substretch, qname) for key, i in sorted(leads.items())]
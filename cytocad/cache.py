@@ -0,0 +1,82 @@
+"""
+Cache parsed alignments and probe coverage of a BAM file for re-runs.
+
+Copyright (C) 2021 Tham Cheng Yong
+
+This file is part of CytoCAD.
+
+CytoCAD is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+CytoCAD is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with CytoCAD.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+import os
+import json
+import shutil
+import numpy as np
+from collections import OrderedDict
+from cytocad import __version__
+from cytocad.intervals import AlignmentTable
+
+
+# Identify a BAM file and the settings its probe coverage depends on
+def cache_key(bam, ref_build, interval, interval_buf, target_depth=None):
+    stat = os.stat(bam)
+    return {'bam': os.path.abspath(bam), 'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'build': ref_build,
+            'interval': interval, 'buffer': interval_buf, 'target_depth': target_depth, 'version': __version__}
+
+
+# Cache directory of a sample in the work directory
+def cache_dir(wk_dir, sample_name):
+    return os.path.join(wk_dir, sample_name + '.cache')
+
+
+# Load alignment table, base coverage and probe coverage if the cache matches key, else return None
+def load_cache(path, key):
+    try:
+        with open(os.path.join(path, 'key.json')) as f:
+            if json.load(f) != key:
+                return None
+        with open(os.path.join(path, 'contigs.json')) as f:
+            contigs, chroms = json.load(f)
+        columns = [np.load(os.path.join(path, col + '.npy'), mmap_mode='r')
+                   for col in ('contig', 'starts', 'ends', 'readid')]
+        basecov = int(np.load(os.path.join(path, 'basecov.npy')))
+        probe_cov = OrderedDict()
+        for chromo in chroms:
+            probe_cov[chromo] = (np.load(os.path.join(path, 'cov_' + chromo + '.npy'), mmap_mode='r'),
+                                 np.load(os.path.join(path, 'filter_' + chromo + '.npy'), mmap_mode='r'))
+    except (OSError, ValueError):
+        return None
+    # Read names are not cached
+    return AlignmentTable(contigs, *columns, None, presorted=True), basecov, probe_cov
+
+
+# Write alignment table, base coverage and probe coverage under key, replacing any previous cache
+def save_cache(path, key, subdata, basecov, probe_cov):
+    tmp_path = path + '.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    with open(os.path.join(tmp_path, 'contigs.json'), 'w') as f:
+        json.dump([subdata.contigs, list(probe_cov)], f)
+    for col in ('contig', 'starts', 'ends', 'readid'):
+        np.save(os.path.join(tmp_path, col + '.npy'), getattr(subdata, col))
+    np.save(os.path.join(tmp_path, 'basecov.npy'), np.array(basecov, dtype=np.uint64))
+    for chromo in probe_cov:
+        np.save(os.path.join(tmp_path, 'cov_' + chromo + '.npy'), probe_cov[chromo][0])
+        np.save(os.path.join(tmp_path, 'filter_' + chromo + '.npy'), probe_cov[chromo][1])
+    # Key is written last so an interrupted write is never loaded
+    with open(os.path.join(tmp_path, 'key.json'), 'w') as f:
+        json.dump(key, f)
+    shutil.rmtree(path, ignore_errors=True)
+    os.rename(tmp_path, path)
@@ -1,5 +1,5 @@
 """
-A wrapper for tagore.
+Chromosome ideogram illustration of CNVs, drawn in-process or with the tagore executable.
 
 Copyright (C) 2021 Tham Cheng Yong
 
@@ -21,21 +21,46 @@ along with CytoCAD.  If not, see <https://www.gnu.org/licenses/>.
 
 
 import os
-# import pickle
-# import cytocad
+import pickle
+import pkgutil
 import logging
+import importlib.util
+import distutils.spawn
+from multiprocessing import Pool
 from subprocess import Popen, PIPE, STDOUT
-# from cytocad.tagore import draw
 
 
-# Wrapper to visualize CNVs using tagore
-def tagore_wrapper(tagout, sample_name, wk_dir, ref_build, oformat):
-    # Write tagore BED to file
+# Write tagore BED and draw ideogram with the chosen renderer, native falls back to tagore when unavailable
+def draw_ideogram(tagout, sample_name, wk_dir, ref_build, oformat, renderer='auto'):
+    out_path = write_tagore_bed(tagout, sample_name, wk_dir)
+    prefix = os.path.join(wk_dir, sample_name + '.ideo')
+    if renderer != 'tagore' and native_available():
+        native_render(tagout, prefix, ref_build, oformat)
+    elif renderer == 'native':
+        logging.critical("Error: Native ideogram renderer needs the tagore package and cairosvg or rsvg-convert")
+        raise Exception("Error: Native ideogram renderer needs the tagore package and cairosvg or rsvg-convert")
+    else:
+        tagore_run(out_path, prefix, ref_build, oformat)
+
+
+# Write tagore BED to file
+def write_tagore_bed(tagout, sample_name, wk_dir):
     out_path = os.path.join(wk_dir, sample_name + '.tagore.bed')
     outwrite = open(out_path, 'w')
     _ = outwrite.write('\n'.join(tagout))
     outwrite.close()
+    return out_path
+
+
+# Wrapper to visualize CNVs using tagore
+def tagore_wrapper(tagout, sample_name, wk_dir, ref_build, oformat):
+    out_path = write_tagore_bed(tagout, sample_name, wk_dir)
     prefix = os.path.join(wk_dir, sample_name + '.ideo')
+    tagore_run(out_path, prefix, ref_build, oformat)
+
+
+# Run tagore executable on a tagore BED file
+def tagore_run(out_path, prefix, ref_build, oformat):
     process = Popen(['tagore', '-i', out_path, '-p', prefix, '-b', ref_build, '-ofmt', oformat, '-f'],
                     universal_newlines=True, stdout=PIPE, stderr=STDOUT)
     with process.stdout:
@@ -52,26 +77,113 @@ def log_subprocess(out):
             logging.debug(line.strip())
 
 
-# Wrapper to visualize CNVs using tagore standalone
-# def tagore_standalone(tagout, sample_name, wk_dir, ref_build):
-#     # Write tagore BED to file
-#     out_path = os.path.join(wk_dir, sample_name + '.tagore.bed')
-#     outwrite = open(out_path, 'w')
-#     _ = outwrite.write('\n'.join(tagout))
-#     outwrite.close()
-#     prefix = os.path.join(wk_dir, sample_name + '.ideo')
-#     tag_args = TagoreArgs(out_path, prefix, ref_build)
-#     data_dir = os.path.join(os.path.dirname(cytocad.__file__), 'data')
-#     base_path = os.path.join(data_dir, 'base.svg.p')
-#     base = open(base_path, 'rb')
-#     __head__, __tail__ = pickle.load(base)
-#     draw(tag_args, __head__, __tail__)
-
-
-# Format tagore arguments
-# class TagoreArgs:
-#
-#     def __init__(self, bed_path, sample_prefix, ref_build):
-#         self.input = bed_path
-#         self.prefix = sample_prefix
-#         self.build = ref_build
+# Check if the native renderer can run, without importing its modules
+def native_available():
+    if importlib.util.find_spec('tagore') is None:
+        return False
+    return importlib.util.find_spec('cairosvg') is not None or distutils.spawn.find_executable('rsvg-convert') is not None
+
+
+# Check that the chosen renderer, or its tagore fallback, can run
+def check_renderer(renderer):
+    if renderer != 'tagore' and native_available():
+        return
+    if renderer == 'native':
+        logging.critical("Error: Native ideogram renderer needs the tagore package and cairosvg or rsvg-convert")
+        raise Exception("Error: Native ideogram renderer needs the tagore package and cairosvg or rsvg-convert")
+
+    # Check for tagore executable
+    if distutils.spawn.find_executable('tagore'):
+        pass
+    else:
+        logging.critical("Error: %s executable is not in PATH, please install tagore" % 'tagore')
+        raise Exception("Error: %s executable is not in PATH, please install tagore" % 'tagore')
+
+    # Check for rsvg-convert executable
+    if distutils.spawn.find_executable('rsvg-convert'):
+        pass
+    else:
+        logging.critical("Error: %s executable is not in PATH, try sudo apt-get install librsvg2-bin" % 'rsvg-convert')
+        raise Exception("Error: %s executable is not in PATH, try sudo apt-get install librsvg2-bin" % 'rsvg-convert')
+
+
+# Build ideogram SVG of tagore lines in memory, with the base SVG and coordinates of the tagore package
+def ideogram_svg(tagout, ref_build):
+    from tagore.main import COORDINATES, CHROM_SIZES
+    header, footer = pickle.loads(pkgutil.get_data('tagore', 'base.svg.p'))
+    if ref_build in CHROM_SIZES:
+        sizes = CHROM_SIZES[ref_build]
+    else:
+        # Other builds are drawn on the chromosome outlines of tagore, scaled by sizes of their reference bundle
+        from cytocad.reference import load_reference
+        sizes = dict((contig.replace('chr', ''), size) for contig, size in
+                     load_reference(ref_build).contig_lengths().items())
+    svg = [header]
+    for line in tagout:
+        if line.startswith('#'):
+            continue
+        chrm, start, stop, feature, size, col, chrcopy = line.rstrip().split('\t')
+        chrm = chrm.replace('chr', '')
+        if feature != '0':
+            raise Exception('Error: Native ideogram renderer only draws rectangle features')
+        coord = COORDINATES[chrm]
+        # Rectangle of chromosome copy 1 (left) or 2 (right), as drawn by tagore
+        feat_start = int(start) * coord['ht'] / sizes[chrm]
+        feat_end = int(stop) * coord['ht'] / sizes[chrm]
+        width = coord['width'] * float(size) / 2
+        if chrcopy == '1':
+            x_pos = coord['cx'] - width
+        else:
+            x_pos = coord['cx']
+        y_pos = coord['cy'] + feat_start
+        svg.append('<rect x="%s" y="%s" fill="%s" width="%s" height="%s"/>\n'
+                   % (x_pos, y_pos, col, width, feat_end - feat_start))
+    svg.append(footer)
+    svg.append('</svg>')
+    return ''.join(svg)
+
+
+# Draw ideogram SVG and rasterize it in-process with cairosvg, or with rsvg-convert when cairosvg is missing
+def native_render(tagout, prefix, ref_build, oformat):
+    svg = ideogram_svg(tagout, ref_build)
+    svg_path = prefix + '.svg'
+    out_path = prefix + '.' + oformat
+    outwrite = open(svg_path, 'w')
+    _ = outwrite.write(svg)
+    outwrite.close()
+    if importlib.util.find_spec('cairosvg') is not None:
+        import cairosvg
+        if oformat == 'pdf':
+            cairosvg.svg2pdf(bytestring=svg.encode(), write_to=out_path)
+        else:
+            cairosvg.svg2png(bytestring=svg.encode(), write_to=out_path)
+    else:
+        process = Popen(['rsvg-convert', '-o', out_path, '-f', oformat, svg_path],
+                        universal_newlines=True, stdout=PIPE, stderr=STDOUT)
+        with process.stdout:
+            log_subprocess(process.stdout)
+        exitcode = process.wait()
+        if exitcode != 0:
+            logging.critical("Error: rsvg-convert failed")
+            raise Exception("Error: rsvg-convert failed, see log")
+
+
+# Draw ideograms of many samples from their tagore BED files in a pool of processes
+def draw_ideograms(samples, ref_build, oformat, renderer='auto', workers=1):
+    jobs = [(sample_name, wk_dir, ref_build, oformat, renderer) for sample_name, wk_dir in samples]
+    if workers > 1 and len(jobs) > 1:
+        with Pool(min(workers, len(jobs))) as pool:
+            return pool.map(ideogram_worker, jobs)
+    return [ideogram_worker(job) for job in jobs]
+
+
+# Draw ideogram of one sample from its tagore BED file and return its name and error message, if any
+def ideogram_worker(job):
+    sample_name, wk_dir, ref_build, oformat, renderer = job
+    try:
+        with open(os.path.join(wk_dir, sample_name + '.tagore.bed')) as f:
+            tagout = f.read().split('\n')
+        draw_ideogram(tagout, sample_name, wk_dir, ref_build, oformat, renderer)
+    except Exception as e:
+        return sample_name, str(e)
+    return sample_name, None
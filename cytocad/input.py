@@ -20,9 +20,11 @@ along with CytoCAD.  If not, see <https://www.gnu.org/licenses/>.
 """
 
 
+import os
 import sys
 import argparse
 from cytocad import __version__
+from cytocad.instrument import STAGES
 
 
 # Parse input
@@ -33,17 +35,174 @@ through coverage anormaly detection (CAD) using low-depth whole-genome sequencin
 
     parser.add_argument("input", type=str,
                         metavar="[BAM]",
-                        help="""path to mapped BAM file.
-Format: .bam""")
+                        help="""path to mapped BAM file, or to a coverage track of
+chromosome, start, end and depth columns, such as
+bedGraph or mosdepth regions (bgzip and tabix optional).
+Or '-' to read SAM or BAM grouped by read name from
+standard input (E.g. minimap2 -a ref.mmi reads.fq | 
+cytocad - work_dir --name sample).
+Format: .bam, .bedgraph, .bg, .bed, .counts""")
 
     parser.add_argument("dir", type=str,
                         metavar="[work_directory]",
                         help="""path to work directory. Directory will be created 
 if it does not exist.""")
 
+    parser.add_argument("-n", "--name", type=str, metavar="str",
+                        default=None,
+                        help="""sample name of output files [input file name, or 
+'stdin']""")
+
+    add_options(parser)
+
+    args = parser.parse_args(args)
+    return args
+
+
+# Parse input of batch mode
+def batch_parser(args=sys.argv[2:]):
+    parser = argparse.ArgumentParser(description="Run CytoCAD on a cohort of BAM files with a pool of worker processes, \
+skipping samples finished by a previous run.",
+                                     formatter_class=argparse.RawTextHelpFormatter, usage=batch_msg())
+
+    parser.add_argument("input", type=str,
+                        metavar="[samples]",
+                        help="""sample sheet with a BAM path, or a sample name and 
+BAM path separated by tab, per line. Or a quoted 
+glob pattern of BAM files (E.g. 'bams/*.bam').
+Coverage tracks may be given in place of BAM files""")
+
+    parser.add_argument("dir", type=str,
+                        metavar="[work_directory]",
+                        help="""path to cohort work directory. Each sample is 
+written to its own subdirectory""")
+
+    parser.add_argument("-w", "--workers", type=int, metavar="int",
+                        default=1,
+                        help="number of samples analysed concurrently [1]")
+
+    parser.add_argument("-m", "--memory", type=float, metavar="float",
+                        default=None,
+                        help="""memory budget of each worker in GB, a sample 
+exceeding it fails without stopping the batch [None]""")
+
+    add_options(parser)
+
+    args = parser.parse_args(args)
+    return args
+
+
+# Parse input of reference bundle building
+def build_ref_parser(args=sys.argv[2:]):
+    parser = argparse.ArgumentParser(description="Build a reference bundle of a genome build from BED files, loaded \
+by CytoCAD runs with '-b build'.",
+                                     formatter_class=argparse.RawTextHelpFormatter, usage=build_ref_msg())
+
+    parser.add_argument("build", type=str,
+                        metavar="[build]",
+                        help="name of the genome build (E.g. hg19, t2t)")
+
+    parser.add_argument("--sizes", type=str, metavar="path", required=True,
+                        help="""BED file of chromosome, start and end of each 
+main chromosome""")
+
+    parser.add_argument("--filter", type=str, metavar="path", required=True,
+                        help="""BED file of gaps, centromeres, telomeres and other 
+regions excluded from coverage""")
+
+    parser.add_argument("--ideogram", type=str, metavar="path", required=True,
+                        help="""BED file of chromosome, start, end and name of 
+cytogenetic bands (E.g. UCSC cytoBandIdeo)""")
+
+    parser.add_argument("-g", "--genome_size", type=int, metavar="int",
+                        default=None,
+                        help="""genome size used as denominator of sample depth 
+[sum of chromosome sizes]""")
+
+    parser.add_argument("--probes", type=str, metavar="str",
+                        default='50000:10,500000:10',
+                        help="""comma-separated interval:buffer settings with 
+precomputed probe filter masks [50000:10,500000:10]""")
+
+    parser.add_argument("-o", "--out", type=str, metavar="path",
+                        default=os.path.join(os.path.expanduser('~'), '.cytocad', 'ref'),
+                        help="""directory of reference bundles, also searched 
+when set in environment variable CYTOCAD_REF 
+[~/.cytocad/ref]""")
+
+    args = parser.parse_args(args)
+    return args
+
+
+# Parse input of service mode
+def serve_parser(args=sys.argv[2:]):
+    parser = argparse.ArgumentParser(description="Run CytoCAD as a service with a warm pool of worker processes, taking \
+jobs as JSON over HTTP or a Unix socket. The options below are defaults of each job.",
+                                     formatter_class=argparse.RawTextHelpFormatter, usage=serve_msg())
+
+    parser.add_argument("--host", type=str, metavar="str",
+                        default='127.0.0.1',
+                        help="address to listen on [127.0.0.1]")
+
+    parser.add_argument("--port", type=int, metavar="int",
+                        default=8460,
+                        help="port to listen on [8460]")
+
+    parser.add_argument("--socket", type=str, metavar="path",
+                        default=None,
+                        help="""listen on a Unix socket at this path instead of 
+host and port [None]""")
+
+    parser.add_argument("-w", "--workers", type=int, metavar="int",
+                        default=1,
+                        help="number of jobs run concurrently [1]")
+
+    parser.add_argument("-m", "--memory", type=float, metavar="float",
+                        default=None,
+                        help="""memory budget of each worker in GB, a job 
+exceeding it fails without stopping the service [None]""")
+
+    parser.add_argument("--timeout", type=float, metavar="float",
+                        default=None,
+                        help="""seconds a job may run before its worker is killed 
+and the job fails [None]""")
+
+    add_options(parser)
+
+    args = parser.parse_args(args)
+    return args
+
+
+# Parse input of plot rendering
+def plot_parser(args=sys.argv[2:]):
+    parser = argparse.ArgumentParser(description="Render coverage plots from signals saved by runs with --add_plots, \
+such as runs with --defer_plots.",
+                                     formatter_class=argparse.RawTextHelpFormatter, usage=plot_msg())
+
+    parser.add_argument("dirs", type=str, nargs='+',
+                        metavar="[work_directory]",
+                        help="""work directories of samples, with saved signals 
+in their 'fig' directory""")
+
+    parser.add_argument("-f", "--format", type=str, metavar="str",
+                        default='svg', choices=['svg', 'png', 'pdf'],
+                        help="format of coverage plots (svg/png/pdf) [svg]")
+
+    parser.add_argument("-w", "--workers", type=int, metavar="int",
+                        default=1,
+                        help="number of work directories rendered concurrently [1]")
+
+    args = parser.parse_args(args)
+    return args
+
+
+# Options shared by single sample and batch modes
+def add_options(parser):
     parser.add_argument("-b", "--build", type=str, metavar="str",
                         default='hg38',
-                        help="""build version of human reference genome assembly [hg38]""")
+                        help="""build version of human reference genome assembly, 
+with a reference bundle made by cytocad build-ref 
+unless hg38, or the path of a bundle [hg38]""")
 
     parser.add_argument("-c", "--colors", nargs='+', metavar="hex_color",
                         default=None,
@@ -54,6 +213,12 @@ ideograms respectively separated by space ['#a6a6a6' '#990000' '#000099']""")
                         default='png',
                         help="Output format of chromosome illustration figure [png]")
 
+    parser.add_argument("--renderer", type=str, metavar="[auto/native/tagore]",
+                        default='auto', choices=['auto', 'native', 'tagore'],
+                        help="""chromosome ideogram renderer, in-process drawing 
+(needs cairosvg or rsvg-convert) or the tagore 
+executable. auto falls back to tagore [auto]""")
+
     parser.add_argument("-i", "--interval", type=int, metavar="int",
                         default=50000,
                         help="""spread between each point in a chromosome where "
@@ -68,20 +233,64 @@ detection size ~= interval*rolling [50000]""")
                         default=10,
                         help="rolling mean window size [10]")
 
-    parser.add_argument("-p", "--penalty", type=int, metavar="int",
-                        default=500,
+    parser.add_argument("-p", "--penalty", type=int_list, metavar="int",
+                        default=[500],
                         help="""Linear kernel penalty value for change 
-point detection using Ruptures [500]""")
+point detection using Ruptures. Comma-separated 
+values run a sweep (E.g. 100,250,500) [500]""")
 
-    parser.add_argument("-s", "--scale", type=float, metavar="float",
-                        default=0.25,
+    parser.add_argument("-s", "--scale", type=float_list, metavar="float",
+                        default=[0.25],
                         help="""proportion of mean coverage to be used for 
 buffering to call hetero- and homozygous CNVs 
 (E.g. a heterozygous loss is where a coverage (c) 
-satisfies: mean-mean*scale <= c < mean+mean*scale [0.25]""")
+satisfies: mean-mean*scale <= c < mean+mean*scale. 
+Comma-separated values run a sweep [0.25]""")
+
+    parser.add_argument("--segmenter", type=str, metavar="[native/ruptures]",
+                        default='native', choices=['native', 'ruptures'],
+                        help="""change point detection engine, the built-in linear 
+kernel segmentation or Ruptures KernelCPD [native]""")
+
+    parser.add_argument("-t", "--threads", type=int, metavar="int",
+                        default=1,
+                        help="""number of processes for parsing an indexed BAM 
+file by genomic region and for change point 
+detection by chromosome [1]""")
+
+    parser.add_argument("--target_depth", type=float, metavar="float",
+                        default=None,
+                        help="""subsample reads of a deeper BAM file to about this 
+depth before analysis, keeping all alignments of a 
+read together. Needs a BAM index [off]""")
+
+    parser.add_argument("--preview", type=int, metavar="int", nargs='?',
+                        default=None, const=10,
+                        help="""quick preview from BAM index lookups at every int-th 
+probe instead of reading the whole BAM. Outputs are 
+named ${sample}.preview.* [10]""")
+
+    parser.add_argument("--profile", type=str, metavar="stage", nargs='?',
+                        default=None, const='bam_parse',
+                        choices=STAGES,
+                        help="""write cProfile stats of a stage as 
+${sample}.${stage}.prof and .prof.txt [bam_parse]""")
+
+    parser.add_argument("--no_cache", action='store_true',
+                        help="""do not read or write the parsed BAM cache in 
+work directory""")
 
     parser.add_argument("--add_plots", action='store_true',
-                        help="output additional coverage plots in 'fig' directory")
+                        help="""output additional coverage plots in 'fig' directory, 
+rendered in the background from saved signals""")
+
+    parser.add_argument("--plot_format", type=str, metavar="str",
+                        default='svg', choices=['svg', 'png', 'pdf'],
+                        help="format of coverage plots (svg/png/pdf) [svg]")
+
+    parser.add_argument("--defer_plots", action='store_true',
+                        help="""save signals of coverage plots without rendering 
+them, for cytocad plot""")
 
     parser.add_argument("--debug", action='store_true',
                         help="run in debug mode")
@@ -93,10 +302,46 @@ satisfies: mean-mean*scale <= c < mean+mean*scale [0.25]""")
     parser.add_argument("-q", "--quiet", action='store_true',
                         help="hide verbose")
 
-    args = parser.parse_args(args)
-    return args
-
 
 # Custom usage message
 def msg():
-    return "cytocad [options] [BAM] [WORK_DIRECTORY]"
+    return "cytocad [options] [BAM] [WORK_DIRECTORY]\n       cytocad batch [options] [SAMPLES] [WORK_DIRECTORY]\n" \
+           "       cytocad build-ref [options] --sizes [BED] --filter [BED] --ideogram [BED] [BUILD]\n" \
+           "       cytocad serve [options]\n" \
+           "       cytocad plot [options] [WORK_DIRECTORY ...]"
+
+
+# Custom usage message of batch mode
+def batch_msg():
+    return "cytocad batch [options] [SAMPLES] [WORK_DIRECTORY]"
+
+
+# Custom usage message of reference bundle building
+def build_ref_msg():
+    return "cytocad build-ref [options] --sizes [BED] --filter [BED] --ideogram [BED] [BUILD]"
+
+
+# Custom usage message of service mode
+def serve_msg():
+    return "cytocad serve [options]"
+
+
+# Custom usage message of plot rendering
+def plot_msg():
+    return "cytocad plot [options] [WORK_DIRECTORY ...]"
+
+
+# Parse comma-separated integers
+def int_list(value):
+    try:
+        return [int(i) for i in value.split(',')]
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid comma-separated int values: '%s'" % value)
+
+
+# Parse comma-separated floats
+def float_list(value):
+    try:
+        return [float(i) for i in value.split(',')]
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid comma-separated float values: '%s'" % value)
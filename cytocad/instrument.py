@@ -0,0 +1,139 @@
+"""
+Per-stage timing, memory and count instrumentation of a CytoCAD run.
+
+Copyright (C) 2021 Tham Cheng Yong
+
+This file is part of CytoCAD.
+
+CytoCAD is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+CytoCAD is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with CytoCAD.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+import os
+import json
+import time
+import pstats
+import cProfile
+import resource
+from datetime import datetime
+from contextlib import contextmanager
+from collections import OrderedDict
+from cytocad import __version__
+
+STAGES = ('check_bam', 'read_track', 'cache_load', 'bam_parse', 'stream_parse', 'preview_coverage', 'probe_coverage',
+          'ovl_upper', 'cad', 'ideogram', 'plots')
+
+
+# Record elapsed time, CPU time and peak memory of each stage of a run, with counts of processed items
+class RunReport:
+
+    def __init__(self, sample_name, wk_dir, profile=None, listener=None):
+        self.sample_name = sample_name
+        self.wk_dir = wk_dir
+        self.profile = profile
+        self.listener = listener  # Called with the name of each stage as it starts
+        self.started = datetime.now().isoformat(timespec='seconds')
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        self.children = children_cpu()
+        self.stages = OrderedDict()
+        self.counts = OrderedDict()
+
+    # Time a stage and measure its peak memory, and dump its cProfile stats when it is the profiled stage
+    @contextmanager
+    def stage(self, name):
+        if self.listener is not None:
+            self.listener(name)
+        wall, cpu, children = time.perf_counter(), time.process_time(), children_cpu()
+        reset = reset_peak_rss()
+        profiler = None
+        if self.profile == name:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        try:
+            yield
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                self.dump_profile(profiler, name)
+            self.stages[name] = OrderedDict([('wall', round(time.perf_counter() - wall, 4)),
+                                             ('cpu', round(time.process_time() - cpu, 4)),
+                                             ('children_cpu', round(children_cpu() - children, 4)),
+                                             ('peak_rss_mb', stage_peak_rss() if reset else None)])
+
+    # Record count of processed items
+    def count(self, key, value):
+        self.counts[key] = int(value)
+
+    # Write profile of a stage as pstats file and as text sorted by cumulative time
+    def dump_profile(self, profiler, name):
+        prefix = os.path.join(self.wk_dir, self.sample_name + '.' + name)
+        profiler.dump_stats(prefix + '.prof')
+        with open(prefix + '.prof.txt', 'w') as f:
+            pstats.Stats(profiler, stream=f).sort_stats('cumulative').print_stats(40)
+
+    # Peak memory of the run, the largest of its stages
+    def peak_rss(self):
+        peaks = [stage['peak_rss_mb'] for stage in self.stages.values() if stage['peak_rss_mb'] is not None]
+        return max(peaks) if peaks else None
+
+    # Write report as <sample>.run.json in the work directory
+    def write(self, options=None):
+        report = OrderedDict([('sample', self.sample_name),
+                              ('version', __version__),
+                              ('started', self.started),
+                              ('options', options or {}),
+                              ('stages', self.stages),
+                              ('counts', self.counts),
+                              ('total', OrderedDict([('wall', round(time.perf_counter() - self.wall, 4)),
+                                                     ('cpu', round(time.process_time() - self.cpu, 4)),
+                                                     ('children_cpu', round(children_cpu() - self.children, 4)),
+                                                     ('peak_rss_mb', self.peak_rss()),
+                                                     ('process_children_peak_rss_mb', children_peak_rss())]))])
+        out_path = os.path.join(self.wk_dir, self.sample_name + '.run.json')
+        with open(out_path, 'w') as f:
+            json.dump(report, f, indent=1)
+        return out_path
+
+
+# CPU time of terminated child processes, including pool workers and external programs
+def children_cpu():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+# Peak resident set size in MB of the largest terminated child over the lifetime of the process, such as pool workers.
+# Batch and service workers keep it from earlier samples.
+def children_peak_rss():
+    return round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1)
+
+
+# Reset the peak resident set size of the process kept by Linux, returning False where it cannot be reset. This also
+# resets ru_maxrss of the process.
+def reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        return False
+    return True
+
+
+# Peak resident set size in MB since the last reset
+def stage_peak_rss():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                return round(int(line.split()[1]) / 1024, 1)
+    return None
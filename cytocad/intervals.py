@@ -0,0 +1,183 @@
+"""
+Functions for counting interval overlaps with sorted arrays.
+
+Copyright (C) 2021 Tham Cheng Yong
+
+This file is part of CytoCAD.
+
+CytoCAD is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+CytoCAD is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with CytoCAD.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+import numpy as np
+from collections import defaultdict
+from functools import lru_cache
+
+
+# Sorted start and end arrays of half-open intervals on one contig
+class IntervalSet:
+
+    def __init__(self, starts, ends):
+        self.starts = np.sort(np.asarray(starts, dtype=np.int64))
+        self.ends = np.sort(np.asarray(ends, dtype=np.int64))
+
+    def __len__(self):
+        return len(self.starts)
+
+    # Number of intervals overlapping each query interval, as in bedtools intersect -wa -wb
+    def count(self, qstarts, qends):
+        # Intervals starting before the query end, minus those ending at or before the query start
+        return np.searchsorted(self.starts, qends, side='left') - np.searchsorted(self.ends, qstarts, side='right')
+
+    # Mask of query intervals overlapping at least one interval
+    def overlaps(self, qstarts, qends):
+        return self.count(qstarts, qends) > 0
+
+
+# Coordinate-sorted columnar table of subdata alignments
+class AlignmentTable:
+
+    def __init__(self, contigs, contig, starts, ends, readid, qnames, presorted=False):
+        self.contigs = list(contigs)
+        self.qnames = qnames
+        if presorted:  # Keep columns as given, e.g. memory-mapped arrays
+            self.contig, self.starts, self.ends, self.readid = contig, starts, ends, readid
+            return
+        contig = np.asarray(contig, dtype=np.int32)
+        starts = np.asarray(starts, dtype=np.int64)
+        order = np.lexsort((starts, contig))
+        self.contig = contig[order]
+        self.starts = starts[order]
+        self.ends = np.asarray(ends, dtype=np.int64)[order]
+        self.readid = np.asarray(readid, dtype=np.int64)[order]
+
+    def __len__(self):
+        return len(self.starts)
+
+    # Row slice of each contig in the table
+    def contig_slices(self):
+        bounds = np.searchsorted(self.contig, np.arange(len(self.contigs) + 1), side='left')
+        return {self.contigs[i]: slice(bounds[i], bounds[i + 1]) for i in range(len(self.contigs))
+                if bounds[i] < bounds[i + 1]}
+
+    # Make IntervalSet objects per contig
+    def intervals(self):
+        return {rname: IntervalSet(self.starts[s], self.ends[s]) for rname, s in self.contig_slices().items()}
+
+    # Write table to an uncompressed npz file
+    def save(self, path):
+        np.savez(path, contigs=np.array(self.contigs, dtype=str), contig=self.contig, starts=self.starts,
+                 ends=self.ends, readid=self.readid, qnames=np.array(self.qnames, dtype=str))
+
+    # Read table from an npz file written by save
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            return cls(f['contigs'].tolist(), f['contig'], f['starts'], f['ends'], f['readid'], f['qnames'].tolist())
+
+
+# Depth values of non-overlapping intervals of one contig, such as bedGraph records or counts of bins
+class DepthTrack:
+
+    def __init__(self, starts, ends, values):
+        order = np.argsort(np.asarray(starts, dtype=np.int64), kind='stable')
+        self.starts = np.asarray(starts, dtype=np.int64)[order]
+        self.ends = np.asarray(ends, dtype=np.int64)[order]
+        self.values = np.asarray(values, dtype=float)[order]
+
+    def __len__(self):
+        return len(self.starts)
+
+    # Depth at the middle of each query interval, in place of the number of alignments overlapping it
+    def count(self, qstarts, qends):
+        mid = (np.asarray(qstarts, dtype=np.int64) + np.asarray(qends, dtype=np.int64)) // 2
+        i = np.maximum(np.searchsorted(self.starts, mid, side='right') - 1, 0)
+        if not len(self.starts):
+            return np.zeros(len(mid))
+        return np.where((mid >= self.starts[i]) & (mid < self.ends[i]), self.values[i], 0.0)
+
+    # Mask of query intervals with non-zero depth
+    def overlaps(self, qstarts, qends):
+        return self.count(qstarts, qends) > 0
+
+    # Sum of depth over all bases
+    def bases(self):
+        return float(np.sum(self.values * (self.ends - self.starts)))
+
+
+# Coverage track of several contigs, used in place of an AlignmentTable
+class CoverageTrack:
+
+    def __init__(self, tracks):
+        self.tracks = tracks
+        self.contigs = list(tracks)
+        self.basecov = sum(track.bases() for track in tracks.values())
+
+    def __len__(self):
+        return sum(len(track) for track in self.tracks.values())
+
+    # DepthTrack objects per contig
+    def intervals(self):
+        return self.tracks
+
+
+# Make IntervalSet objects per contig from a BED file, parsed once per process
+@lru_cache(maxsize=None)
+def bed_intervals(path):
+    starts = defaultdict(list)
+    ends = defaultdict(list)
+    with open(path) as f:
+        for line in f:
+            if line.startswith('#'):
+                continue
+            rname, start, end = line.split('\t')[0:3]
+            starts[rname].append(int(start))
+            ends[rname].append(int(end))
+    return {rname: IntervalSet(starts[rname], ends[rname]) for rname in starts}
+
+
+# Empty IntervalSet for contigs without intervals
+def empty_intervals():
+    return IntervalSet([], [])
+
+
+# Sorted start, end and name arrays of the ideogram bands of one chromosome
+class BandIndex:
+
+    def __init__(self, starts, ends, names):
+        order = np.argsort(np.asarray(starts, dtype=np.int64), kind='stable')
+        self.starts = np.asarray(starts, dtype=np.int64)[order]
+        self.ends = np.asarray(ends, dtype=np.int64)[order]
+        self.names = np.asarray(names, dtype=object)[order]
+
+    # Name of the band with start < position <= end for each position
+    def lookup(self, positions):
+        return self.names[np.searchsorted(self.ends, positions, side='left')]
+
+
+# Make BandIndex objects per chromosome from an ideogram BED file, parsed once per process
+@lru_cache(maxsize=None)
+def ideogram_bands(path):
+    starts = defaultdict(list)
+    ends = defaultdict(list)
+    names = defaultdict(list)
+    with open(path) as f:
+        for line in f:
+            if line.startswith('#'):
+                continue
+            rname, start, end, name = line.split('\t')[0:4]
+            starts[rname].append(int(start))
+            ends[rname].append(int(end))
+            names[rname].append(name)
+    return {rname: BandIndex(starts[rname], ends[rname], names[rname]) for rname in starts}
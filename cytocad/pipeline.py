@@ -0,0 +1,462 @@
+"""
+Run CytoCAD analysis of single samples and cohorts of samples.
+
+Copyright (C) 2021 Tham Cheng Yong
+
+This file is part of CytoCAD.
+
+CytoCAD is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+CytoCAD is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with CytoCAD.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+import os
+import glob
+import logging
+import resource
+import pysam
+from datetime import datetime
+from multiprocessing import Pool, current_process
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from cytocad.track import is_track, track_name
+
+# Input path of alignments grouped by read name on standard input
+STDIN = '-'
+
+
+# Check BAM file and obtain sample name
+def check_bam(file_path):
+    filename = os.path.basename(file_path)
+    bam_suffix = '.bam'
+    contig_list = []
+    if filename.lower().endswith(bam_suffix):
+        save = pysam.set_verbosity(0)  # Suppress BAM index missing warning
+        sam = pysam.AlignmentFile(file_path, "rb")
+        pysam.set_verbosity(save)  # Revert verbosity level
+        try:
+            assert sam.is_bam, "Error: Input BAM file is not a BAM file."
+            sample_name = os.path.basename(file_path).rsplit('.bam', 1)[0]
+            # Get BAM contigs from header
+            header = sam.header.to_dict()
+            for h in header['SQ']:
+                contig_list.append(h['SN'])
+        except AssertionError:
+            logging.critical("Error: Input BAM file is not a BAM file.")
+            raise Exception("Error: Input BAM file is not a BAM file.")
+        finally:
+            sam.close()
+    else:
+        logging.critical("Error: Input file is not recognised, please ensure file suffix has '.bam', or '.bedgraph', "
+                         "'.bg', '.bed' or '.counts' for coverage tracks")
+        raise Exception("Error: Input file is not recognised, please ensure file suffix has '.bam', or '.bedgraph', "
+                        "'.bg', '.bed' or '.counts' for coverage tracks")
+
+    # Check if BAM contig names are appropriate
+    for i in contig_list:
+        if not i.startswith('chr'):
+            logging.critical("Error: Contig %s in BAM has unconventional naming, please ensure contig name starts with 'chr'" % i)
+            raise Exception("Error: Contig %s in BAM has unconventional naming, please ensure contig name starts with 'chr'" % i)
+    return sample_name
+
+
+# Genome size and chromosome length dict of a reference build
+def reference_sizes(ref_build):
+    from cytocad.reference import load_reference
+    ref = load_reference(ref_build)
+    return ref.gsize, ref.contig_lengths()
+
+
+# Analyse one BAM file or coverage track and write its outputs to the work directory
+def run_sample(
+        file_path,
+        wk_dir,
+        sample_name=None,
+        ref_build='hg38',
+        cov_plots=False,
+        colors=None,
+        oformat='png',
+        interval=50000,
+        interval_buf=10,
+        rolling=10,
+        penalty=(500,),
+        scale=(0.25,),
+        threads=1,
+        segmenter='native',
+        use_cache=True,
+        renderer='auto',
+        render=True,
+        profile=None,
+        target_depth=None,
+        preview=None,
+        listener=None,
+        plot_format='svg',
+        defer_plots=False
+):
+    from cytocad.bam_coverage import bam_parse
+    from cytocad.depth_limit import ovl_upper
+    from cytocad.change_detection import cad_sweep, sweep_summary, probe_coverage
+    from cytocad.cache import cache_key, cache_dir, load_cache, save_cache
+    from cytocad.ideogram import draw_ideogram, write_tagore_bed
+    from cytocad.instrument import RunReport
+    from cytocad.track import read_track
+    from cytocad.preview import preview_coverage
+    from cytocad.stream import stream_coverage
+    from cytocad.depth_limit import depth_upper
+    from cytocad.plots import plot_worker
+
+    report = RunReport(sample_name, wk_dir, profile, listener)
+    track = is_track(file_path)
+    stream = file_path == STDIN
+    if track or stream:
+        if sample_name is None:
+            sample_name = track_name(file_path) if track else 'stdin'
+            report.sample_name = sample_name
+    else:
+        now = datetime.now()
+        now_str = now.strftime("[%d/%m/%Y %H:%M:%S]")
+        print(now_str + ' - Assessing BAM file...')
+        with report.stage('check_bam'):
+            bam_name = check_bam(file_path)
+        if sample_name is None:
+            sample_name = bam_name
+            report.sample_name = bam_name
+    if preview and track:
+        logging.warning("Warning: Preview mode is ignored for coverage track %s" % file_path)
+        preview = None
+    if stream and (preview or target_depth):
+        logging.warning("Warning: Preview mode and target depth are ignored for alignments from standard input")
+        preview = None
+    if preview:
+        # Mark all outputs of a preview, at a coarse interval of every preview-th probe
+        sample_name = sample_name + '.preview'
+        report.sample_name = sample_name
+        interval = interval * preview
+
+    # Setup working directory
+    if not os.path.exists(wk_dir):
+        os.makedirs(wk_dir)
+    if cov_plots:
+        if not os.path.exists(os.path.join(wk_dir, 'fig')):
+            os.makedirs(os.path.join(wk_dir, 'fig'))
+
+    total_gsize, chrom_len_dict = reference_sizes(ref_build)
+
+    # Load subdata alignment and probe coverage from cache of a previous run on the same BAM
+    cached = None
+    sampled = None
+    if use_cache and not track and not preview and not stream:
+        key = cache_key(file_path, ref_build, interval, interval_buf, target_depth)
+        with report.stage('cache_load'):
+            cached = load_cache(cache_dir(wk_dir, sample_name), key)
+    if track:
+        # Read precomputed coverage track, which is quick enough not to be cached
+        if target_depth:
+            logging.warning("Warning: Target depth is ignored for coverage track %s" % file_path)
+        now = datetime.now()
+        now_str = now.strftime("[%d/%m/%Y %H:%M:%S]")
+        print(now_str + ' - Reading coverage track...')
+        with report.stage('read_track'):
+            subdata = read_track(file_path, list(chrom_len_dict))
+        basecov = subdata.basecov
+        with report.stage('probe_coverage'):
+            probe_cov = probe_coverage(subdata, ref_build, interval, interval_buf)
+    elif preview:
+        # Fetch windows at coarse probes through the BAM index instead of reading the whole BAM
+        now = datetime.now()
+        now_str = now.strftime("[%d/%m/%Y %H:%M:%S]")
+        print(now_str + ' - Sampling BAM index for preview...')
+        with report.stage('preview_coverage'):
+            probe_cov, depth, upper_cov = preview_coverage(file_path, total_gsize, ref_build, interval,
+                                                           interval_buf)
+        depth = round(depth, 2)
+        subdata = None
+    elif stream:
+        # Resolve reads and count probe coverage as alignments arrive, without keeping them
+        now = datetime.now()
+        now_str = now.strftime("[%d/%m/%Y %H:%M:%S]")
+        print(now_str + ' - Reading alignments from standard input...')
+        stats = {}
+        with report.stage('stream_parse'):
+            probe_cov, basecov, data2, n = stream_coverage(file_path, total_gsize, chrom_len_dict, ref_build,
+                                                           interval, interval_buf, stats)
+        for k in stats:
+            report.count(k, stats[k])
+        subdata = None
+    elif cached is not None:
+        now = datetime.now()
+        now_str = now.strftime("[%d/%m/%Y %H:%M:%S]")
+        print(now_str + ' - Loading cached BAM analysis...')
+        subdata, basecov, probe_cov = cached
+    else:
+        # Create subdata alignment using BAM
+        now = datetime.now()
+        now_str = now.strftime("[%d/%m/%Y %H:%M:%S]")
+        print(now_str + ' - Analyzing BAM file...')
+        stats = {}
+        with report.stage('bam_parse'):
+            subdata, basecov = bam_parse(file_path, threads=threads, stats=stats, target_depth=target_depth or 0,
+                                         gsize=total_gsize)
+        sampled = stats.pop('sampled_fraction', None)
+        for k in stats:
+            report.count(k, stats[k])
+        with report.stage('probe_coverage'):
+            probe_cov = probe_coverage(subdata, ref_build, interval, interval_buf)
+        if use_cache:
+            save_cache(cache_dir(wk_dir, sample_name), key, subdata, basecov, probe_cov)
+
+    if subdata is not None:
+        report.count('track_intervals' if track else 'alignments', len(subdata))
+    report.count('probes', sum(len(probe_cov[chromo][0]) for chromo in probe_cov))
+
+    if not preview:
+        # Calculate overall depth crudely
+        depth = round(float(basecov) / total_gsize, 2)
+
+        # Calculate upper depth limit (=3*Mean absolute deviation around median above median)
+        with report.stage('ovl_upper'):
+            if stream:
+                upper_cov = depth_upper(data2, n, wk_dir, cov_plots)
+            else:
+                upper_cov = ovl_upper(total_gsize, chrom_len_dict, subdata, wk_dir, cov_plots)
+
+    # Peform coverage anomaly detection
+    now = datetime.now()
+    now_str = now.strftime("[%d/%m/%Y %H:%M:%S]")
+    print(now_str + ' - Estimating coverage and CAD...')
+    with report.stage('cad'):
+        results = cad_sweep(subdata,
+                            depth,
+                            upper_cov,
+                            sample_name,
+                            ref_build=ref_build,
+                            interval=interval,
+                            interval_buf=interval_buf,
+                            rolling_size=rolling,
+                            penalties=penalty,
+                            zygo_scales=scale,
+                            cov_plots=cov_plots,
+                            wk_dir=wk_dir,
+                            colors=colors,
+                            probe_cov=probe_cov,
+                            threads=threads,
+                            segmenter=segmenter)
+
+    # Render coverage plots from their saved signals in the background, so that outputs do not wait on them. Plots
+    # are left to the batch in batch mode, and to cytocad plot when deferred.
+    plots = cov_plots and render and not defer_plots
+    plotting = None
+    if plots and not current_process().daemon:  # Workers of a process pool cannot start processes
+        plotting = Pool(1)
+        plotted = plotting.apply_async(plot_worker, ((wk_dir, plot_format),))
+
+    # The plot process is stopped on errors too, so that failed jobs of the service leave no process behind
+    try:
+        if len(results) == 1:
+            out, tag = results[(penalty[0], scale[0])]
+            report.count('cnvs', len(out))
+
+            # Chromosome ideogram, drawn later for all samples of a batch
+            if render:
+                now = datetime.now()
+                now_str = now.strftime("[%d/%m/%Y %H:%M:%S]")
+                print(now_str + ' - Creating chromosome illustraions...')
+                with report.stage('ideogram'):
+                    draw_ideogram(tag, sample_name, wk_dir, ref_build, oformat, renderer)
+            else:
+                write_tagore_bed(tag, sample_name, wk_dir)
+
+            # Write results to BED file, last so that its presence marks a finished sample
+            out_path = os.path.join(wk_dir, sample_name + ".CNV.bed")
+            outwrite = open(out_path + '.tmp', 'w')
+            _ = outwrite.write('\n'.join(out) + '\n')
+            outwrite.close()
+            os.rename(out_path + '.tmp', out_path)
+        else:
+            # Write results of each penalty and scale combination to BED file, without illustrations
+            for (p, s), (out, tag) in results.items():
+                out_path = os.path.join(wk_dir, sample_name + ".p" + str(p) + ".s" + str(s) + ".CNV.bed")
+                outwrite = open(out_path, 'w')
+                _ = outwrite.write('\n'.join(out) + '\n')
+                outwrite.close()
+            sweep_path = os.path.join(wk_dir, sample_name + ".sweep.tsv")
+            outwrite = open(sweep_path, 'w')
+            _ = outwrite.write('\n'.join(sweep_summary(results)) + '\n')
+            outwrite.close()
+
+        if plots:
+            with report.stage('plots'):
+                if plotting is None:
+                    _, error = plot_worker((wk_dir, plot_format))
+                else:
+                    _, error = plotted.get()
+            if error is not None:
+                logging.error("Error: Coverage plots of sample %s failed: %s" % (sample_name, error))
+    finally:
+        if plotting is not None:
+            plotting.terminate()
+            plotting.join()
+    report.write({'track' if track else 'bam': 'stdin' if stream else os.path.abspath(file_path), 'build': ref_build, 'interval': interval,
+                  'buffer': interval_buf, 'rolling': rolling, 'penalty': list(penalty), 'scale': list(scale),
+                  'threads': threads, 'segmenter': segmenter, 'cache': cached is not None,
+                  'target_depth': target_depth, 'sampled_fraction': sampled, 'preview': preview})
+    return results
+
+
+# Sample name of an input BAM file or coverage track
+def input_name(file_path):
+    if is_track(file_path):
+        return track_name(file_path)
+    return os.path.basename(file_path).rsplit('.bam', 1)[0]
+
+
+# Read sample names and input paths from a sample sheet, or from BAM files or coverage tracks matching a glob pattern
+def read_samples(source):
+    samples = []
+    if os.path.isfile(source) and not source.lower().endswith('.bam') and not is_track(source):
+        # Sample sheet of one BAM path, or a sample name and BAM path, per line
+        with open(source) as f:
+            for line in f:
+                fields = line.split()
+                if not fields or fields[0].startswith('#'):
+                    continue
+                if len(fields) == 1:
+                    samples.append((input_name(fields[0]), fields[0]))
+                elif len(fields) == 2:
+                    samples.append((fields[0], fields[1]))
+                else:
+                    raise Exception("Error: Sample sheet line '%s' has to be a BAM path or a sample name and BAM path"
+                                    % line.strip())
+    else:
+        for path in sorted(glob.glob(source)):
+            samples.append((input_name(path), path))
+    if not samples:
+        raise Exception("Error: No BAM files or coverage tracks found in %s" % source)
+    names = [name for name, path in samples]
+    for name in set(names):
+        if names.count(name) > 1:
+            raise Exception("Error: Sample name %s is used more than once" % name)
+    return samples
+
+
+# CNV BED path of a sample in a cohort work directory
+def sample_bed_path(wk_dir, sample_name):
+    return os.path.join(wk_dir, sample_name, sample_name + '.CNV.bed')
+
+
+# Analyse samples in a bounded number of worker processes and merge their CNV calls into a cohort table
+def run_batch(samples, wk_dir, workers=1, memory=None, **options):
+    from cytocad.reference import load_reference
+    from cytocad.ideogram import draw_ideograms
+    from cytocad.plots import draw_plots
+
+    # Load reference data once, forked workers share it
+    load_reference(options.get('ref_build', 'hg38'))
+
+    # Skip samples finished by a previous run
+    jobs = []
+    for sample_name, file_path in samples:
+        if os.path.exists(sample_bed_path(wk_dir, sample_name)):
+            print('Skipping finished sample ' + sample_name)
+        else:
+            jobs.append((file_path, os.path.join(wk_dir, sample_name), sample_name, memory,
+                         dict(options, render=False)))
+    failed = []
+    running = {}
+    while jobs or running:
+        # One single-worker executor per sample, so that a worker killed by the memory budget or the system fails its
+        # own sample only, rather than hanging the batch or breaking a shared pool
+        while jobs and len(running) < workers:
+            job = jobs.pop(0)
+            executor = ProcessPoolExecutor(1)
+            running[executor.submit(batch_worker, job)] = (job[2], executor)
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+            sample_name, executor = running.pop(future)
+            executor.shutdown()
+            try:
+                sample_name, error = future.result()
+            except BrokenProcessPool:
+                error = 'worker process exited, such as by exceeding the memory budget'
+            except Exception as e:  # Raised outside the sample, such as in passing its result
+                error = '%s: %s' % (type(e).__name__, e)
+            if error is None:
+                print('Finished sample ' + sample_name)
+            else:
+                logging.error("Error: Sample %s failed: %s" % (sample_name, error))
+                print('Failed sample ' + sample_name + ': ' + error)
+                failed.append(sample_name)
+
+    # Draw ideograms of finished samples in parallel, including those missing from an interrupted run
+    oformat = options.get('oformat', 'png')
+    drawn = [(sample_name, os.path.join(wk_dir, sample_name)) for sample_name, file_path in samples
+             if os.path.exists(sample_bed_path(wk_dir, sample_name))
+             and not os.path.exists(os.path.join(wk_dir, sample_name, sample_name + '.ideo.' + oformat))]
+    if drawn:
+        now = datetime.now()
+        now_str = now.strftime("[%d/%m/%Y %H:%M:%S]")
+        print(now_str + ' - Creating chromosome illustraions of %i samples...' % len(drawn))
+    for sample_name, error in draw_ideograms(drawn, options.get('ref_build', 'hg38'), oformat,
+                                             options.get('renderer', 'auto'), workers):
+        if error is not None:
+            logging.error("Error: Ideogram of sample %s failed: %s" % (sample_name, error))
+            print('Failed ideogram of sample ' + sample_name + ': ' + error)
+
+    # Render coverage plots of finished samples in parallel, including those missing from an interrupted run
+    if options.get('cov_plots') and not options.get('defer_plots'):
+        plot_format = options.get('plot_format', 'svg')
+        plotted = [os.path.join(wk_dir, sample_name) for sample_name, file_path in samples
+                   if os.path.exists(sample_bed_path(wk_dir, sample_name))
+                   and not os.path.exists(os.path.join(wk_dir, sample_name, 'fig',
+                                                       sample_name + '_cov1.' + plot_format))]
+        if plotted:
+            now = datetime.now()
+            now_str = now.strftime("[%d/%m/%Y %H:%M:%S]")
+            print(now_str + ' - Creating coverage plots of %i samples...' % len(plotted))
+        for plot_dir, error in draw_plots(plotted, plot_format, workers):
+            if error is not None:
+                logging.error("Error: Coverage plots of %s failed: %s" % (plot_dir, error))
+                print('Failed coverage plots of ' + plot_dir + ': ' + error)
+
+    # Merge CNV calls of finished samples
+    cohort = ['#sample\tchr\tstart\tstop\tbands\tcoverage\tcopy\tzygosity']
+    for sample_name, file_path in samples:
+        if os.path.exists(sample_bed_path(wk_dir, sample_name)):
+            with open(sample_bed_path(wk_dir, sample_name)) as f:
+                for line in f:
+                    if line.strip():
+                        cohort.append(sample_name + '\t' + line.rstrip('\n'))
+    outwrite = open(os.path.join(wk_dir, 'cohort.CNV.tsv'), 'w')
+    _ = outwrite.write('\n'.join(cohort) + '\n')
+    outwrite.close()
+    return failed
+
+
+# Limit address space of a worker process, in gigabytes
+def limit_memory(memory):
+    if memory:
+        limit = int(memory * 1024 ** 3)
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+# Run one sample of a batch within the memory budget and return its name and error message, if any
+def batch_worker(job):
+    file_path, wk_dir, sample_name, memory, options = job
+    limit_memory(memory)
+    try:
+        run_sample(file_path, wk_dir, sample_name, **options)
+    except MemoryError:
+        return sample_name, 'memory budget exceeded'
+    except Exception as e:
+        return sample_name, str(e)
+    return sample_name, None
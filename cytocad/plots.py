@@ -0,0 +1,173 @@
+"""
+Save signals of coverage plots during analysis, and render them in a separate stage or with cytocad plot.
+
+Copyright (C) 2021 Tham Cheng Yong
+
+This file is part of CytoCAD.
+
+CytoCAD is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+CytoCAD is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with CytoCAD.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+import os
+import glob
+import numpy as np
+from multiprocessing import Pool
+
+DEPTH_DATA = 'depth_of_coverage.npz'
+COV_DATA = '.cov.npz'
+
+
+# Save histogram of depth samples with the upper limit shown by the depth of coverage curve
+def save_depth(data, n, upper_limit, wk_dir):
+    np.savez(os.path.join(wk_dir, 'fig', DEPTH_DATA), hist=np.bincount(data.astype(int)), n=n,
+             upper_limit=upper_limit)
+
+
+# Save scaled coverage and change points of each chromosome, as segmented by cad
+def save_coverage(segmented, sample_name, wk_dir, mean_cov, chrx_avg, zygo_scale):
+    arrays = {'chroms': np.array([chromo for chromo, xcoord, signal_plot, result, lines in segmented]),
+              'scalars': np.array([mean_cov, chrx_avg, zygo_scale])}
+    for chromo, xcoord, signal_plot, result, lines in segmented:
+        arrays[chromo + '.x'] = xcoord
+        arrays[chromo + '.signal'] = signal_plot
+        arrays[chromo + '.breaks'] = np.array(result, dtype=np.int64)
+    np.savez(os.path.join(wk_dir, 'fig', sample_name + COV_DATA), **arrays)
+
+
+# Render the plots of a work directory from their saved data, in the given format
+def render_plots(wk_dir, oformat='svg'):
+    fig_dir = os.path.join(wk_dir, 'fig')
+    if os.path.exists(os.path.join(fig_dir, DEPTH_DATA)):
+        with np.load(os.path.join(fig_dir, DEPTH_DATA)) as f:
+            curve(f['hist'], int(f['n']), float(f['upper_limit']), wk_dir, oformat)
+    for path in sorted(glob.glob(os.path.join(fig_dir, '*' + COV_DATA))):
+        with np.load(path) as f:
+            segmented = [(chromo, f[chromo + '.x'], f[chromo + '.signal'], f[chromo + '.breaks'].tolist())
+                         for chromo in f['chroms']]
+            mean_cov, chrx_avg, zygo_scale = f['scalars']
+        sample_name = os.path.basename(path)[:-len(COV_DATA)]
+        coverage_plots(segmented, sample_name, wk_dir, mean_cov, chrx_avg, zygo_scale, oformat)
+
+
+# Render plots of many work directories in a pool of processes
+def draw_plots(wk_dirs, oformat='svg', workers=1):
+    jobs = [(wk_dir, oformat) for wk_dir in wk_dirs]
+    if workers > 1 and len(jobs) > 1:
+        with Pool(min(workers, len(jobs))) as pool:
+            return pool.map(plot_worker, jobs)
+    return [plot_worker(job) for job in jobs]
+
+
+# Render plots of one work directory and return it with an error message, if any
+def plot_worker(job):
+    wk_dir, oformat = job
+    try:
+        render_plots(wk_dir, oformat)
+    except Exception as e:
+        return wk_dir, str(e)
+    return wk_dir, None
+
+
+# Pyplot with a non-interactive backend, imported on first use
+def pyplot():
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    return plt
+
+
+# Plot curve from histogram of depth samples
+def curve(hist, n, upper_limit, wk_dir, oformat='svg'):
+    import matplotlib
+    import matplotlib.ticker as mticker
+    from scipy.interpolate import make_interp_spline
+    plt = pyplot()
+    c = max(int(upper_limit), 10)
+    p = np.pad(hist, (0, max(c - len(hist), 0)))[:c].tolist()
+    p.append(n - sum(p))
+    y = np.array([(float(z)/n) for z in p])
+    # theoretical = [0.0915, 0.0441, 0.1032, 0.1498, 0.1739, 0.1626,
+    # 0.1132, 0.0808, 0.0412, 0.0247, 0.0097, 0.0028, 0.0015,
+    # 0.0006, 0.0002, 0.0002, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0]
+    c = np.array(range(max(int(upper_limit), 10)+1))
+    xnew = np.linspace(c.min(), c.max(), 100)
+    spl = make_interp_spline(c, y)
+    smooth = spl(xnew)
+    params = {'axes.labelsize': 14, 'axes.titlesize': 17, 'legend.fontsize': 10, 'xtick.labelsize': 12, 'ytick.labelsize': 12,
+              'font.family': 'Arial, Helvetica, sans-serif'}
+    matplotlib.rcParams.update(params)
+    fig = plt.figure(figsize=(8, 6))
+    fig.patch.set_facecolor('#f6f7f9')
+    ax = fig.add_subplot(111)
+    ax.plot(xnew, smooth, color='#403f7d', linewidth=2.0)
+    ax.set_facecolor('#ebebff')
+    plt.text(int(upper_limit), y[-1], '>=' + str(int(upper_limit)))
+    ax.grid(color='w', linestyle='-', linewidth=1)
+    vals = ax.get_yticks().tolist()
+    ax.yaxis.set_major_locator(mticker.FixedLocator(vals))
+    ax.set_yticklabels(['{:,.1%}'.format(x) for x in vals])
+    plt.ylabel('Percentage')
+    plt.xlabel('Depth of coverage')
+    ax.legend(['Input sequencing data'], loc='upper right', ncol=1, fancybox=True)
+    plt.savefig(os.path.join(wk_dir, 'fig', 'total_depth_of_coverage.' + oformat),
+                bbox_inches='tight',
+                dpi=100,
+                facecolor=fig.get_facecolor(),
+                edgecolor='none')
+    plt.close(fig)
+
+
+# Plot scaled coverage and change point spans of each chromosome, in figures of eight chromosomes
+def coverage_plots(segmented, sample_name, wk_dir, mean_cov, chrx_avg, zygo_scale, oformat='svg'):
+    plt = pyplot()
+    groups = [[0, 8], [8, 16], [16, 24]]
+    cycle = 1
+    for g in groups:
+        fig = plt.figure()
+        n = 1
+        for chromo, xcoord, signal_plot, result in segmented[g[0]:g[1]]:
+            if chromo == 'chrX' and mean_cov - mean_cov * zygo_scale <= chrx_avg:  # XX
+                signal_plot *= 2
+            span = []
+            if len(result) % 2 != 0:
+                result.append(0)
+                result_iter = iter(result)
+                for i in result_iter:
+                    span.append([i, next(result_iter)])
+                _ = span.pop(-1)
+            else:
+                result_iter = iter(result)
+                for i in result_iter:
+                    span.append([i, next(result_iter)])
+            ax = fig.add_subplot(2, 4, n)
+            ax.plot(xcoord, signal_plot, label='SMA', color='red', alpha=0.8)
+            for p in span:
+                ax.axvspan(xcoord[p[0] - 1], xcoord[p[1] - 1], alpha=0.3, color='blue')
+            ax.set_title(chromo)
+            ax.set_ylim(0, 5)
+            ax.set_yticks(np.arange(0, 5, 1))
+            ax.yaxis.grid(True)
+            n += 1
+        fig.add_subplot(111, frame_on=False)
+        plt.tick_params(labelcolor="none", bottom=False, left=False)
+        plt.xlabel('Coordinate (MB)')
+        plt.ylabel('Copy number')
+        plt.tight_layout()
+        fig_out_path = os.path.join(wk_dir, 'fig', sample_name + '_cov' + str(cycle) + '.' + oformat)
+        plt.savefig(fig_out_path,
+                    dpi=100
+                    )
+        plt.close(fig)
+        cycle += 1
@@ -0,0 +1,56 @@
+"""
+Estimate coverage of a quick preview from BAM index lookups at a subset of probe positions.
+
+Copyright (C) 2021 Tham Cheng Yong
+
+This file is part of CytoCAD.
+
+CytoCAD is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+CytoCAD is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with CytoCAD.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+import logging
+import pysam
+import numpy as np
+from collections import OrderedDict
+from cytocad.bam_coverage import estimate_depth, resolved_record
+from cytocad.change_detection import probe_windows
+from cytocad.depth_limit import upper_limit
+
+
+# Probe coverage, depth and upper depth limit of an indexed BAM from windows fetched at every probe position of the
+# given interval, which is a strided subset of the probes of a full run
+def preview_coverage(bam, gsize, ref_build='hg38', interval=500000, interval_buf=10):
+    save = pysam.set_verbosity(0)  # Suppress BAM index missing warning
+    sam = pysam.AlignmentFile(bam, "rb")
+    pysam.set_verbosity(save)  # Revert verbosity level
+    probe_cov = OrderedDict()
+    try:
+        if not sam.has_index():
+            logging.critical("Error: Preview mode needs a BAM index, please index %s with samtools index" % bam)
+            raise Exception("Error: Preview mode needs a BAM index, please index %s with samtools index" % bam)
+        references = set(sam.references)
+        depth = estimate_depth(sam, gsize)
+        for chromo, (starts, ends, filtered) in probe_windows(ref_build, interval, interval_buf).items():
+            counts = np.zeros(len(starts), dtype=np.int64)
+            # Filtered probes are assigned mean coverage by cad, so only the others are fetched. Records are counted
+            # only if a full run keeps their aligned segment, so secondary alignments do not inflate the coverage
+            if chromo in references:
+                for i in np.flatnonzero(~filtered):
+                    counts[i] = sam.count(chromo, int(starts[i]), int(ends[i]), read_callback=resolved_record)
+            probe_cov[chromo] = (counts, filtered)
+    finally:
+        sam.close()
+    upper_cov = upper_limit(np.concatenate([counts[~filtered] for counts, filtered in probe_cov.values()]))
+    return probe_cov, depth, upper_cov
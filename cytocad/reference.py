@@ -0,0 +1,210 @@
+"""
+Build and load reference bundles of contig sizes, filtered regions, ideogram bands and probe filter masks.
+
+Copyright (C) 2021 Tham Cheng Yong
+
+This file is part of CytoCAD.
+
+CytoCAD is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+CytoCAD is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with CytoCAD.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+import os
+import json
+import shutil
+import numpy as np
+from functools import lru_cache
+from collections import OrderedDict
+from cytocad import __version__
+from cytocad.intervals import IntervalSet, BandIndex, bed_intervals, ideogram_bands
+
+BUNDLE_SUFFIX = '.cytoref'
+BUNDLE_FORMAT = 1
+
+# Probe interval and buffer settings with precomputed filter masks, of default and preview runs
+DEFAULT_PROBES = ((50000, 10), (500000, 10))
+
+# Genome sizes of builds with BED files packaged in cytocad/data, used as denominator of sample depth
+PACKAGED_GSIZES = {'hg38': 3209286105}
+
+
+# Directories searched for reference bundles by build name, in order
+def bundle_dirs():
+    dirs = []
+    if os.environ.get('CYTOCAD_REF'):
+        dirs.extend(os.environ['CYTOCAD_REF'].split(os.pathsep))
+    dirs.append(os.path.join(os.path.expanduser('~'), '.cytocad', 'ref'))
+    dirs.append(os.path.join(os.path.dirname(__file__), 'data'))
+    return dirs
+
+
+# Contig sizes, filtered regions, ideogram bands and probe filter masks of a reference build
+class Reference:
+
+    def __init__(self, build, gsize, contigs, starts, ends, filters, bands, masks=None):
+        self.build = build
+        self.gsize = gsize
+        self.contigs = list(contigs)
+        self.starts = [int(x) for x in starts]
+        self.ends = [int(x) for x in ends]
+        self.filters = filters  # IntervalSet per contig
+        self.bands = bands  # BandIndex per contig
+        self.masks = masks or {}  # Concatenated filter masks of all probes per (interval, buffer)
+
+    # Build from a chromosome size BED file, a filtered region BED file and an ideogram band BED file
+    @classmethod
+    def from_beds(cls, build, sizes_path, filter_path, ideo_path, gsize=None, probes=DEFAULT_PROBES):
+        contigs, starts, ends = [], [], []
+        with open(sizes_path) as f:
+            for line in f:
+                if line.startswith('#') or not line.strip():
+                    continue
+                chrm, start, end = line.split('\t')[0:3]
+                contigs.append(chrm)
+                starts.append(int(start))
+                ends.append(int(end))
+        if gsize is None:
+            gsize = sum(ends)
+        ref = cls(build, gsize, contigs, starts, ends, bed_intervals(filter_path), ideogram_bands(ideo_path))
+        for interval, interval_buf in probes:
+            ref.masks[(interval, interval_buf)] = ref.compute_mask(interval, interval_buf)
+        return ref
+
+    # Load a bundle directory, with arrays memory-mapped
+    @classmethod
+    def load(cls, path):
+        with open(os.path.join(path, 'reference.json')) as f:
+            meta = json.load(f)
+        if meta.get('format') != BUNDLE_FORMAT:
+            raise Exception("Error: Reference bundle %s has format %s, please rebuild it with cytocad build-ref"
+                            % (path, meta.get('format')))
+        arrays = {}
+        for name in ('filter_starts', 'filter_ends', 'filter_index', 'band_starts', 'band_ends', 'band_index'):
+            arrays[name] = np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+        filters = {}
+        bands = {}
+        for i, contig in enumerate(meta['contigs']):
+            a, b = arrays['filter_index'][i], arrays['filter_index'][i + 1]
+            if b > a:
+                filters[contig] = IntervalSet(arrays['filter_starts'][a:b], arrays['filter_ends'][a:b])
+            a, b = arrays['band_index'][i], arrays['band_index'][i + 1]
+            if b > a:
+                bands[contig] = BandIndex(arrays['band_starts'][a:b], arrays['band_ends'][a:b],
+                                          meta['band_names'][contig])
+        masks = {}
+        for interval, interval_buf in meta['probes']:
+            masks[(interval, interval_buf)] = np.load(os.path.join(path, 'mask_%i_%i.npy' % (interval, interval_buf)),
+                                                      mmap_mode='r')
+        return cls(meta['build'], meta['genome_size'], meta['contigs'], meta['starts'], meta['ends'], filters, bands,
+                   masks)
+
+    # Write as a bundle directory, replacing an existing one
+    def save(self, path):
+        tmp = path + '.tmp'
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        band_names = OrderedDict()
+        columns = {'filter_starts': [], 'filter_ends': [], 'band_starts': [], 'band_ends': []}
+        filter_index = [0]
+        band_index = [0]
+        for contig in self.contigs:
+            if contig in self.filters:
+                columns['filter_starts'].append(self.filters[contig].starts)
+                columns['filter_ends'].append(self.filters[contig].ends)
+            filter_index.append(filter_index[-1] + len(self.filters.get(contig, ())))
+            if contig in self.bands:
+                columns['band_starts'].append(self.bands[contig].starts)
+                columns['band_ends'].append(self.bands[contig].ends)
+                band_names[contig] = self.bands[contig].names.tolist()
+            band_index.append(band_index[-1] + len(band_names.get(contig, ())))
+        for name, parts in columns.items():
+            np.save(os.path.join(tmp, name + '.npy'), np.concatenate(parts or [[]]).astype(np.int64))
+        np.save(os.path.join(tmp, 'filter_index.npy'), np.array(filter_index, dtype=np.int64))
+        np.save(os.path.join(tmp, 'band_index.npy'), np.array(band_index, dtype=np.int64))
+        for (interval, interval_buf), mask in self.masks.items():
+            np.save(os.path.join(tmp, 'mask_%i_%i.npy' % (interval, interval_buf)), np.asarray(mask, dtype=bool))
+        meta = OrderedDict([('format', BUNDLE_FORMAT), ('version', __version__), ('build', self.build),
+                            ('genome_size', self.gsize), ('contigs', self.contigs), ('starts', self.starts),
+                            ('ends', self.ends), ('probes', [list(k) for k in self.masks]),
+                            ('band_names', band_names)])
+        with open(os.path.join(tmp, 'reference.json'), 'w') as f:
+            json.dump(meta, f)
+        shutil.rmtree(path, ignore_errors=True)
+        os.rename(tmp, path)
+        return path
+
+    # Chromosome length dict
+    def contig_lengths(self):
+        return OrderedDict(zip(self.contigs, self.ends))
+
+    # Genomic coordinates of interval points for each chromosome
+    def probe_points(self, interval):
+        chr_range = OrderedDict()
+        for contig, start, end in zip(self.contigs, self.starts, self.ends):
+            chr_range[contig] = np.arange(start, end, interval, dtype=np.int64)
+        return chr_range
+
+    # Whether the buffered window of each interval point falls in a filtered region, per chromosome
+    def probe_mask(self, interval, interval_buf):
+        mask = self.masks.get((interval, interval_buf))
+        if mask is None:
+            mask = self.compute_mask(interval, interval_buf)
+        filtered = OrderedDict()
+        offset = 0
+        for contig, points in self.probe_points(interval).items():
+            filtered[contig] = mask[offset:offset + len(points)]
+            offset += len(points)
+        return filtered
+
+    # Concatenated filter mask of the interval points of all chromosomes
+    def compute_mask(self, interval, interval_buf):
+        masks = []
+        for contig, points in self.probe_points(interval).items():
+            starts = np.maximum(points - interval_buf, 1)
+            ends = points + interval_buf
+            masks.append(self.filters.get(contig, IntervalSet([], [])).overlaps(starts, ends))
+        return np.concatenate(masks)
+
+
+# Bundle path of a build name, or None if not found
+def find_bundle(ref_build):
+    if os.path.isfile(os.path.join(ref_build, 'reference.json')):
+        return ref_build
+    for d in bundle_dirs():
+        path = os.path.join(d, ref_build + BUNDLE_SUFFIX)
+        if os.path.isfile(os.path.join(path, 'reference.json')):
+            return path
+    return None
+
+
+# Load reference of a build name or bundle path once per process, from its bundle or else from packaged BED files
+@lru_cache(maxsize=None)
+def load_reference(ref_build):
+    path = find_bundle(ref_build)
+    if path is not None:
+        return Reference.load(path)
+    beds = packaged_beds(ref_build)
+    if all(os.path.isfile(p) for p in beds):
+        return Reference.from_beds(ref_build, *beds, gsize=PACKAGED_GSIZES.get(ref_build))
+    raise Exception("Error: Reference genome build %s is not recognised. Please build its reference bundle with "
+                    "cytocad build-ref, or give the path of a bundle directory. Bundles are searched in %s."
+                    % (ref_build, ', '.join(bundle_dirs())))
+
+
+# Chromosome size, filtered region and ideogram BED files of a build packaged in cytocad/data
+def packaged_beds(ref_build):
+    data_dir = os.path.join(os.path.dirname(__file__), 'data')
+    return (os.path.join(data_dir, ref_build + '_sizes_main.bed'),
+            os.path.join(data_dir, ref_build + '_curated_filter_main_arte.bed'),
+            os.path.join(data_dir, ref_build + '_ucsc_ideogram.bed'))
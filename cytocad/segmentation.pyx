@@ -0,0 +1,225 @@
+"""
+Penalized change point detection with a linear kernel
+
+Copyright (C) 2021 Tham Cheng Yong
+
+This file is part of CytoCAD.
+
+CytoCAD is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+CytoCAD is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with CytoCAD.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+cimport cython
+import numpy as np
+from libc.math cimport INFINITY, NAN, sqrt, signbit
+
+
+# Penalized segmentation with the cost of ruptures.KernelCPD(kernel="linear"), computed from cumulative sums.
+# Candidate segment starts are pruned functionally (FPOP): each candidate keeps the range of segment means
+# where its cost is lowest, and is dropped once that range is empty.
+cdef class NativeCPD:
+    cdef public int min_size
+    cdef public object sums, sqsums
+
+    def __init__(self, int min_size=2):
+        self.min_size = min_size
+        self.sums = None
+        self.sqsums = None
+
+    # Store cumulative sums of the signal and of its square
+    def fit(self, signal):
+        x = np.asarray(signal, dtype=np.double).ravel()
+        x = x - x.mean()  # Cost is shift invariant, centering limits rounding error
+        self.sums = np.concatenate(([0.0], np.cumsum(x)))
+        self.sqsums = np.concatenate(([0.0], np.cumsum(x * x)))
+        return self
+
+    # Return sorted breakpoints for penalty pen, ending with the number of samples
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    @cython.cdivision(True)
+    @cython.always_allow_keywords(True)
+    def predict(self, double pen):
+        cdef:
+            double[::1] P = self.sums
+            double[::1] D = self.sqsums
+            int n = P.shape[0] - 1
+            int min_size = self.min_size
+            double[::1] F = np.zeros(n + 1)
+            int[::1] path = np.zeros(n + 1, dtype=np.intc)
+            int[::1] cand = np.zeros(n + 1, dtype=np.intc)
+            int[::1] seen = np.full(n + 1, -1, dtype=np.intc)
+            # Partition of segment means into intervals [bnd[i], bnd[i + 1]) won by candidate own[i]
+            double[::1] bnd = np.empty(2 * n + 4)
+            double[::1] bnd2 = np.empty(2 * n + 4)
+            int[::1] own = np.empty(2 * n + 4, dtype=np.intc)
+            int[::1] own2 = np.empty(2 * n + 4, dtype=np.intc)
+            double[::1] tmp_bnd
+            int[::1] tmp_own
+            int t, s, i, k, m, ncand, nint, best, new
+            double val, fmin, seg, A, B, C, disc, sq, r1, r2, lo, hi
+        if n < 2 * min_size:
+            return [n]
+        # No change point is possible before 2*min_size samples
+        for t in range(1, 2 * min_size):
+            F[t] = D[t] - P[t] * P[t] / t + pen
+        cand[0] = 0
+        ncand = 1
+        bnd[0] = -INFINITY
+        bnd[1] = INFINITY
+        own[0] = 0
+        nint = 1
+        for t in range(2 * min_size, n + 1):
+            # Last sample starting a segment of at least min_size becomes a candidate
+            new = t - min_size
+            if new >= min_size:
+                # Split each interval where the new candidate has lower cost. The cost difference to an
+                # older candidate s is the quadratic A*mu^2 - 2*B*mu + C, which does not change with t.
+                m = 0
+                for i in range(nint):
+                    s = own[i]
+                    lo = bnd[i]
+                    hi = bnd[i + 1]
+                    A = new - s
+                    B = P[new] - P[s]
+                    C = D[new] - D[s] + F[s] - F[new]
+                    disc = B * B - A * C
+                    if disc <= 0:
+                        r1 = hi
+                        r2 = hi
+                    else:
+                        sq = sqrt(disc)
+                        r1 = (B - sq) / A
+                        r2 = (B + sq) / A
+                    # New candidate wins below r1 and above r2, s keeps the range between
+                    if r1 > lo:
+                        m = push_interval(bnd2, own2, m, lo, new)
+                    if r1 < hi and r2 > lo:
+                        m = push_interval(bnd2, own2, m, max(lo, r1), s)
+                    if r2 < hi:
+                        m = push_interval(bnd2, own2, m, max(lo, r2), new)
+                bnd2[m] = INFINITY
+                tmp_bnd, tmp_own = bnd, own
+                bnd, own = bnd2, own2
+                bnd2, own2 = tmp_bnd, tmp_own
+                nint = m
+                # Drop candidates left without any interval
+                for i in range(nint):
+                    seen[own[i]] = t
+                k = 0
+                for i in range(ncand):
+                    if seen[cand[i]] == t:
+                        cand[k] = cand[i]
+                        k += 1
+                if seen[new] == t:
+                    cand[k] = new
+                    k += 1
+                ncand = k
+            # Earliest candidate wins ties, as in ruptures
+            fmin = INFINITY
+            best = 0
+            for i in range(ncand):
+                s = cand[i]
+                seg = P[t] - P[s]
+                val = F[s] + D[t] - D[s] - seg * seg / (t - s) + pen
+                if val < fmin:
+                    fmin = val
+                    best = s
+            F[t] = fmin
+            path[t] = best
+        bkps = []
+        t = n
+        while t > 0:
+            bkps.append(t)
+            t = path[t]
+        return bkps[::-1]
+
+
+# Append interval starting at left to a partition, merging it with the previous interval of the same owner
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline int push_interval(double[::1] bnd, int[::1] own, int m, double left, int owner):
+    if m > 0 and own[m - 1] == owner:
+        return m
+    bnd[m] = left
+    own[m] = owner
+    return m + 1
+
+
+# Trailing mean of each window of the given size, NaN before the first full window. Running sums are compensated as in
+# pandas Series.rolling(window).mean(), so results are identical to it.
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def rolling_mean(values, int window):
+    cdef:
+        double[::1] x = np.ascontiguousarray(values, dtype=np.double)
+        Py_ssize_t n = x.shape[0]
+        double[::1] out = np.empty(n)
+        Py_ssize_t i, nobs = 0, neg = 0, same = 0
+        double total = 0, add_comp = 0, remove_comp = 0, prev = x[0] if n else 0, v, y, t, result
+    for i in range(n):
+        if i >= window:
+            v = x[i - window]
+            nobs -= 1
+            y = -v - remove_comp
+            t = total + y
+            remove_comp = t - total - y
+            total = t
+            if signbit(v):
+                neg -= 1
+        v = x[i]
+        nobs += 1
+        y = v - add_comp
+        t = total + y
+        add_comp = t - total - y
+        total = t
+        if signbit(v):
+            neg += 1
+        same = same + 1 if v == prev else 1
+        prev = v
+        if nobs < window:
+            out[i] = NAN
+            continue
+        result = total / nobs
+        # Constant windows give their value exactly, and rounding does not flip the sign
+        if same >= nobs:
+            result = prev
+        elif neg == 0 and result < 0:
+            result = 0
+        elif neg == nobs and result > 0:
+            result = 0
+        out[i] = result
+    return np.asarray(out)
+
+
+# Mean of each segment between breakpoints, over all points but the last of the segment. Points are summed in order,
+# so means round exactly as a Python sum of the same values would.
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def segment_means(values, bkps):
+    cdef:
+        double[::1] x = np.ascontiguousarray(values, dtype=np.double)
+        Py_ssize_t[::1] ends = np.asarray(bkps, dtype=np.intp)
+        Py_ssize_t n = ends.shape[0]
+        double[::1] out = np.empty(n)
+        Py_ssize_t i, j, start = 0
+        double total
+    for i in range(n):
+        total = 0
+        for j in range(start, ends[i] - 1):
+            total += x[j]
+        out[i] = total / (ends[i] - 1 - start)
+        start = ends[i]
+    return np.asarray(out)
@@ -0,0 +1,361 @@
+"""
+Run CytoCAD as a long-running service with a warm pool of workers, taking jobs over HTTP or a Unix socket.
+
+Copyright (C) 2021 Tham Cheng Yong
+
+This file is part of CytoCAD.
+
+CytoCAD is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+CytoCAD is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with CytoCAD.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+import os
+import json
+import time
+import queue
+import signal
+import logging
+import threading
+import multiprocessing
+from datetime import datetime
+from functools import partial
+from collections import OrderedDict
+from socketserver import ThreadingMixIn, UnixStreamServer
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from cytocad import __version__
+from cytocad.pipeline import run_sample, input_name, limit_memory, STDIN
+from cytocad.instrument import STAGES
+
+# Options of run_sample that a job may set, over the defaults the service was started with, with the values they take
+JOB_OPTIONS = OrderedDict([
+    ('ref_build', ('a string', lambda x: isinstance(x, str))),
+    ('cov_plots', ('true or false', lambda x: isinstance(x, bool))),
+    ('colors', ('a list of three hex colors', lambda x: isinstance(x, list) and len(x) == 3 and
+                all(isinstance(c, str) and c.startswith('#') for c in x))),
+    ('oformat', ('png or pdf', lambda x: x in ('png', 'pdf'))),
+    ('interval', ('a positive integer', lambda x: integer(x) and x > 0)),
+    ('interval_buf', ('an integer of at least 0', lambda x: integer(x) and x >= 0)),
+    ('rolling', ('a positive integer', lambda x: integer(x) and x > 0)),
+    ('penalty', ('a list of numbers', lambda x: isinstance(x, list) and len(x) > 0 and all(number(v) for v in x))),
+    ('scale', ('a list of numbers', lambda x: isinstance(x, list) and len(x) > 0 and all(number(v) for v in x))),
+    ('segmenter', ('native or ruptures', lambda x: x in ('native', 'ruptures'))),
+    ('use_cache', ('true or false', lambda x: isinstance(x, bool))),
+    ('renderer', ('auto, native or tagore', lambda x: x in ('auto', 'native', 'tagore'))),
+    ('target_depth', ('a number above 0 or null', lambda x: x is None or number(x) and x > 0)),
+    ('preview', ('a positive integer or null', lambda x: x is None or integer(x) and x > 0)),
+    ('profile', ('a stage name or null', lambda x: x is None or x in STAGES)),
+    ('plot_format', ('svg, png or pdf', lambda x: x in ('svg', 'png', 'pdf'))),
+    ('defer_plots', ('true or false', lambda x: isinstance(x, bool)))])
+
+# Seconds between checks of running jobs for exited workers and timeouts
+WATCH_INTERVAL = 1.0
+
+# Stage events of workers, set in each worker process
+events = None
+
+
+# Queue of submitted jobs run in a warm process pool with a concurrency limit
+class JobQueue:
+
+    def __init__(self, workers=1, memory=None, options=None, timeout=None):
+        self.options = dict(options or {}, threads=1)  # Pool workers cannot start their own process pools
+        self.workers = workers
+        self.timeout = timeout
+        self.jobs = OrderedDict()
+        self.clock = {}  # Monotonic start time of running jobs
+        self.lock = threading.Lock()
+        self.pending = queue.Queue()
+        self.slots = threading.Semaphore(workers)
+        self.events = multiprocessing.Queue()
+        preload(self.options.get('ref_build', 'hg38'))
+        # Forked workers inherit imported modules and reference data
+        self.pool = multiprocessing.Pool(workers, initializer=serve_init, initargs=(memory, self.events))
+        for target in (self.dispatch, self.listen, self.watch):
+            threading.Thread(target=target, daemon=True).start()
+
+    # Add a job from a request of input path, work directory, optional sample name and options
+    def submit(self, request):
+        if not isinstance(request, dict) or not isinstance(request.get('input'), str) or \
+                not isinstance(request.get('dir'), str):
+            raise ValueError("Job has to be a JSON object with 'input' and 'dir' paths")
+        if not isinstance(request.get('name') or '', str):
+            raise ValueError("Sample name has to be a string")
+        file_path = os.path.abspath(request['input'])
+        if request['input'] == STDIN or not os.path.isfile(file_path):
+            raise ValueError("Input file %s is not found" % request['input'])
+        options = request.get('options', {})
+        if not isinstance(options, dict):
+            raise ValueError("Job options have to be a JSON object")
+        unknown = [key for key in options if key not in JOB_OPTIONS]
+        if unknown:
+            raise ValueError("Unknown job options %s, options are %s" % (', '.join(unknown), ', '.join(JOB_OPTIONS)))
+        for key, value in options.items():
+            if not JOB_OPTIONS[key][1](value):
+                raise ValueError("Job option %s has to be %s, not %s" % (key, JOB_OPTIONS[key][0], json.dumps(value)))
+        sample_name = request.get('name') or input_name(file_path)
+        with self.lock:
+            job_id = str(len(self.jobs) + 1)
+            self.jobs[job_id] = OrderedDict([('id', job_id), ('state', 'queued'), ('input', file_path),
+                                             ('dir', os.path.abspath(request['dir'])), ('name', sample_name),
+                                             ('options', dict(self.options, **options)), ('worker', None),
+                                             ('stage', None), ('stages', []), ('submitted', now()), ('started', None),
+                                             ('finished', None), ('cnvs', None), ('error', None)])
+            job = dict(self.jobs[job_id])
+        self.pending.put(job_id)
+        return job
+
+    # Cancel a queued job, returning False if it has started
+    def cancel(self, job_id):
+        with self.lock:
+            if self.jobs[job_id]['state'] != 'queued':
+                return False
+            self.jobs[job_id]['state'] = 'cancelled'
+            self.jobs[job_id]['finished'] = now()
+        return True
+
+    # Copy of a job, or None
+    def job(self, job_id):
+        with self.lock:
+            if job_id not in self.jobs:
+                return None
+            return dict(self.jobs[job_id])
+
+    # Copies of all jobs
+    def list(self):
+        with self.lock:
+            return [dict(job) for job in self.jobs.values()]
+
+    # Number of jobs in each state, with worker count
+    def summary(self):
+        with self.lock:
+            states = OrderedDict((state, 0) for state in ('queued', 'running', 'finished', 'failed', 'cancelled'))
+            for job in self.jobs.values():
+                states[job['state']] += 1
+        return OrderedDict([('version', __version__), ('workers', self.workers), ('jobs', states)])
+
+    # Start queued jobs in order as workers become free
+    def dispatch(self):
+        while True:
+            job_id = self.pending.get()
+            if job_id is None:
+                return
+            self.slots.acquire()
+            with self.lock:
+                job = self.jobs[job_id]
+                if job['state'] != 'queued':
+                    self.slots.release()
+                    continue
+                job['state'] = 'running'
+                job['started'] = now()
+                self.clock[job_id] = time.monotonic()
+                args = (job_id, job['input'], job['dir'], job['name'], job['options'])
+            self.pool.apply_async(serve_worker, args, callback=self.finish, error_callback=partial(self.crash, job_id))
+
+    # Record worker process ids and stages of running jobs as workers enter them
+    def listen(self):
+        while True:
+            job_id, key, value = self.events.get()
+            with self.lock:
+                if key == 'worker':
+                    self.jobs[job_id]['worker'] = value
+                else:
+                    self.jobs[job_id]['stage'] = value
+                    self.jobs[job_id]['stages'].append(value)
+
+    # Fail running jobs whose worker process has exited, such as by the out-of-memory killer, or that exceed the
+    # timeout, in which case their worker is killed. The pool replaces exited workers but never returns their jobs.
+    def watch(self):
+        while True:
+            time.sleep(WATCH_INTERVAL)
+            alive = {p.pid for p in multiprocessing.active_children()}
+            with self.lock:
+                running = [(job_id, job['worker']) for job_id, job in self.jobs.items() if job['state'] == 'running']
+            for job_id, worker in running:
+                if worker is not None and worker not in alive:
+                    self.end(job_id, None, 'worker process exited')
+                elif self.timeout and time.monotonic() - self.clock[job_id] > self.timeout:
+                    if worker is not None and worker in alive:
+                        os.kill(worker, signal.SIGKILL)
+                    self.end(job_id, None, 'timed out after %s seconds' % self.timeout)
+
+    # Record result of a job returned by a worker
+    def finish(self, result):
+        self.end(*result)
+
+    # Record a job whose worker raised an exception outside the job
+    def crash(self, job_id, e):
+        self.end(job_id, None, '%s: %s' % (type(e).__name__, e))
+
+    # Record result of a running job and free its worker slot, once
+    def end(self, job_id, cnvs, error):
+        with self.lock:
+            job = self.jobs[job_id]
+            if job['state'] != 'running':  # Already failed by watch
+                return
+            job['state'] = 'failed' if error else 'finished'
+            job['finished'] = now()
+            job['cnvs'] = cnvs
+            job['error'] = error
+            del self.clock[job_id]
+        self.slots.release()
+        if error:
+            logging.error("Error: Job %s of sample %s failed: %s" % (job_id, job['name'], error))
+
+    # Stop workers, cancelling running jobs
+    def close(self):
+        self.pending.put(None)
+        self.pool.terminate()
+        self.pool.join()
+
+
+# Import analysis modules and load reference data before workers are forked
+def preload(ref_build):
+    import cytocad.bam_coverage
+    import cytocad.change_detection
+    import cytocad.depth_limit
+    import cytocad.ideogram
+    import cytocad.preview
+    import cytocad.stream
+    import cytocad.track
+    from cytocad.reference import load_reference
+    load_reference(ref_build)
+
+
+# Set memory limit and stage event queue of a worker process, leaving interrupts to the service
+def serve_init(memory, queue_):
+    global events
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    limit_memory(memory)
+    events = queue_
+
+
+# Run one job and return its id, number of CNVs and error message, if any
+def serve_worker(job_id, file_path, wk_dir, sample_name, options):
+    events.put((job_id, 'worker', os.getpid()))
+    try:
+        results = run_sample(file_path, wk_dir, sample_name,
+                             listener=lambda stage: events.put((job_id, 'stage', stage)), **options)
+    except MemoryError:
+        return job_id, None, 'memory budget exceeded'
+    except Exception as e:
+        return job_id, None, str(e)
+    return job_id, sum(len(out) for out, tag in results.values()), None
+
+
+# Whether a JSON value is an integer, booleans excluded
+def integer(x):
+    return isinstance(x, int) and not isinstance(x, bool)
+
+
+# Whether a JSON value is a number, booleans excluded
+def number(x):
+    return isinstance(x, (int, float)) and not isinstance(x, bool)
+
+
+# Current time as ISO string
+def now():
+    return datetime.now().isoformat(timespec='seconds')
+
+
+# JSON endpoints of the job queue:
+#   GET /status, GET /jobs, GET /jobs/<id>, POST /jobs and DELETE /jobs/<id> to cancel a queued job
+class JobHandler(BaseHTTPRequestHandler):
+    server_version = 'CytoCAD/' + __version__
+
+    def do_GET(self):
+        path = self.path.rstrip('/')
+        if path in ('', '/status'):
+            self.reply(200, self.server.jobs.summary())
+        elif path == '/jobs':
+            self.reply(200, self.server.jobs.list())
+        elif path.startswith('/jobs/'):
+            job = self.server.jobs.job(path[len('/jobs/'):])
+            if job is None:
+                self.reply(404, {'error': 'job not found'})
+            else:
+                self.reply(200, job)
+        else:
+            self.reply(404, {'error': 'not found'})
+
+    def do_POST(self):
+        if self.path.rstrip('/') != '/jobs':
+            self.reply(404, {'error': 'not found'})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            job = self.server.jobs.submit(json.loads(self.rfile.read(length).decode() or '{}'))
+        except ValueError as e:
+            self.reply(400, {'error': str(e)})
+            return
+        self.reply(202, job)
+
+    def do_DELETE(self):
+        path = self.path.rstrip('/')
+        job_id = path[len('/jobs/'):] if path.startswith('/jobs/') else None
+        if job_id is None or self.server.jobs.job(job_id) is None:
+            self.reply(404, {'error': 'job not found'})
+        elif self.server.jobs.cancel(job_id):
+            self.reply(200, self.server.jobs.job(job_id))
+        else:
+            self.reply(409, {'error': 'job has already started'})
+
+    # Send a JSON response
+    def reply(self, code, obj):
+        body = (json.dumps(obj, indent=1) + '\n').encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # Unix socket clients have no address
+    def address_string(self):
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        logging.info("%s - %s" % (self.address_string(), format % args))
+
+
+# HTTP server handling requests in threads
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+# HTTP server on a Unix socket handling requests in threads
+class ThreadingUnixServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+
+# Serve the job queue over HTTP on host and port, or on a Unix socket path, until interrupted
+def serve(jobs, host='127.0.0.1', port=8460, socket_path=None):
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = ThreadingUnixServer(socket_path, JobHandler)
+        where = socket_path
+    else:
+        server = ThreadingHTTPServer((host, port), JobHandler)
+        where = 'http://%s:%i' % (host, server.server_address[1])
+    server.jobs = jobs
+    print(now() + ' - CytoCAD serving on %s with %i workers' % (where, jobs.workers))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        signal.signal(signal.SIGINT, signal.SIG_IGN)  # Shut down fully on repeated interrupts
+        server.server_close()
+        jobs.close()
+        if socket_path and os.path.exists(socket_path):
+            os.remove(socket_path)
@@ -0,0 +1,114 @@
+"""
+Accumulate probe coverage from a stream of alignments grouped by read name, such as aligner output on stdin.
+
+Copyright (C) 2021 Tham Cheng Yong
+
+This file is part of CytoCAD.
+
+CytoCAD is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+CytoCAD is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with CytoCAD.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+import logging
+import pysam
+import numpy as np
+from collections import OrderedDict
+from cytocad.bam_coverage import stream_reads
+from cytocad.change_detection import probe_windows
+from cytocad.depth_limit import ngenerate, random_windows
+
+
+# Number of alignments overlapping fixed query windows of each contig, counted in batches as alignments arrive.
+# Gives the same counts as IntervalSet.count of all alignments, without keeping them.
+class WindowCounter:
+
+    def __init__(self, windows):
+        self.order = {}
+        self.starts = {}
+        self.ends = {}
+        self.diff = {}
+        for contig, (starts, ends) in windows.items():
+            # Windows of equal length sorted by start are also sorted by end, so the windows an alignment overlaps
+            # form a contiguous range
+            order = np.argsort(starts, kind='stable')
+            self.order[contig] = order
+            self.starts[contig] = np.asarray(starts, dtype=np.int64)[order]
+            self.ends[contig] = np.asarray(ends, dtype=np.int64)[order]
+            self.diff[contig] = np.zeros(len(order) + 1, dtype=np.int64)
+
+    # Count alignments of a contig given by start and end arrays
+    def add(self, contig, starts, ends):
+        if contig not in self.diff:
+            return
+        lo = np.searchsorted(self.ends[contig], starts, side='right')
+        hi = np.maximum(np.searchsorted(self.starts[contig], ends, side='left'), lo)
+        n = len(self.diff[contig])
+        self.diff[contig] += np.bincount(lo, minlength=n) - np.bincount(hi, minlength=n)
+
+    # Counts of the windows of a contig, in their original order
+    def counts(self, contig):
+        counts = np.empty(len(self.order[contig]), dtype=np.int64)
+        counts[self.order[contig]] = np.cumsum(self.diff[contig])[:-1]
+        return counts
+
+
+# Read a name-grouped SAM or BAM stream and return probe coverage, base coverage and depth at random windows, as
+# probe_coverage and ovl_upper would from the parsed alignments. Memory is bounded by the batch size.
+def stream_coverage(source, total_gsize, contig_len_dict, ref_build='hg38', interval=50000, interval_buf=10,
+                    stats=None, batch=100000, seed=3):
+    save = pysam.set_verbosity(0)
+    sam = pysam.AlignmentFile(source, "r")
+    pysam.set_verbosity(save)
+    if sam.header.to_dict().get('HD', {}).get('SO') == 'coordinate':
+        sam.close()
+        logging.critical("Error: Input stream is sorted by coordinate, please stream alignments grouped by read name, "
+                         "or give the BAM file path instead")
+        raise Exception("Error: Input stream is sorted by coordinate, please stream alignments grouped by read name, "
+                        "or give the BAM file path instead")
+    windows = probe_windows(ref_build, interval, interval_buf)
+    probes = WindowCounter(OrderedDict((chromo, (starts, ends)) for chromo, (starts, ends, filtered) in windows.items()))
+    n = ngenerate(total_gsize)
+    rand = random_windows(contig_len_dict, n, seed=seed)
+    randoms = WindowCounter(OrderedDict((contig, (starts, starts + 100)) for contig, starts in rand.items()))
+    basecov = 0
+    contigs, starts, ends = [], [], []
+    try:
+        for lines, cov in stream_reads(sam, stats=stats):
+            basecov += cov
+            for line in lines:
+                contigs.append(line[0])
+                starts.append(line[1])
+                ends.append(line[1] + line[2])
+            if len(starts) >= batch:
+                count_batch((probes, randoms), contigs, starts, ends)
+                contigs, starts, ends = [], [], []
+        count_batch((probes, randoms), contigs, starts, ends)
+    finally:
+        sam.close()
+    probe_cov = OrderedDict((chromo, (probes.counts(chromo), windows[chromo][2])) for chromo in windows)
+    data2 = np.concatenate([randoms.counts(contig) for contig in rand]).astype(float)
+    return probe_cov, basecov, data2, n
+
+
+# Add a batch of alignments to window counters, by contig
+def count_batch(counters, contigs, starts, ends):
+    if not contigs:
+        return
+    names, index = np.unique(np.array(contigs), return_inverse=True)
+    starts = np.array(starts, dtype=np.int64)
+    ends = np.array(ends, dtype=np.int64)
+    for i, contig in enumerate(names):
+        mask = index == i
+        for counter in counters:
+            counter.add(contig, starts[mask], ends[mask])
@@ -0,0 +1,100 @@
+"""
+Read precomputed coverage tracks as input in place of BAM files.
+
+Copyright (C) 2021 Tham Cheng Yong
+
+This file is part of CytoCAD.
+
+CytoCAD is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+CytoCAD is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with CytoCAD.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+import io
+import os
+import gzip
+import logging
+import pysam
+from cytocad.intervals import DepthTrack, CoverageTrack
+
+TRACK_SUFFIXES = ('.bedgraph', '.bg', '.bed', '.counts')
+
+
+# Check if a file name is a coverage track, optionally gzip or bgzip compressed
+def is_track(file_path):
+    name = file_path.lower()
+    if name.endswith('.gz'):
+        name = name[:-3]
+    return name.endswith(TRACK_SUFFIXES)
+
+
+# Sample name of a coverage track file, without its suffixes and the '.regions' suffix of mosdepth
+def track_name(file_path):
+    name = os.path.basename(file_path)
+    if name.lower().endswith('.gz'):
+        name = name[:-3]
+    name = name.rsplit('.', 1)[0]
+    if name.endswith('.regions'):
+        name = name[:-len('.regions')]
+    return name
+
+
+# Read a bedGraph or per-bin counts file of chromosome, start, end and depth columns into a CoverageTrack.
+# Only the given contigs are read, by tabix when the file is indexed.
+def read_track(file_path, contigs):
+    if os.path.exists(file_path + '.tbi') or os.path.exists(file_path + '.csi'):
+        tbx = pysam.TabixFile(file_path)
+        try:
+            text = '\n'.join(line for contig in contigs if contig in tbx.contigs for line in tbx.fetch(contig))
+        finally:
+            tbx.close()
+        df = parse_track(io.StringIO(text + '\n'), 0)
+    else:
+        df = parse_track(file_path, header_lines(file_path))
+    tracks = {}
+    for contig, rows in df.groupby(0, sort=False):
+        if not contig.startswith('chr'):
+            logging.critical("Error: Contig %s in coverage track has unconventional naming, please ensure contig name "
+                             "starts with 'chr'" % contig)
+            raise Exception("Error: Contig %s in coverage track has unconventional naming, please ensure contig name "
+                            "starts with 'chr'" % contig)
+        if contig in contigs:
+            tracks[contig] = DepthTrack(rows[1].to_numpy(), rows[2].to_numpy(), rows[3].to_numpy())
+    if not tracks:
+        raise Exception("Error: Coverage track %s has no records on main chromosomes" % file_path)
+    return CoverageTrack(tracks)
+
+
+# Parse the first four columns of a track, skipping header_lines lines
+def parse_track(source, header_lines):
+    import pandas as pd
+    try:
+        return pd.read_csv(source, sep='\t', header=None, usecols=[0, 1, 2, 3], skiprows=header_lines,
+                           comment='#', dtype={0: str, 1: 'int64', 2: 'int64', 3: 'float64'})
+    except pd.errors.EmptyDataError:
+        return pd.DataFrame({0: [], 1: [], 2: [], 3: []})
+    except ValueError:
+        logging.critical("Error: Coverage track has to have chromosome, start, end and depth columns")
+        raise Exception("Error: Coverage track has to have chromosome, start, end and depth columns")
+
+
+# Number of browser, track and comment lines at the start of a track
+def header_lines(file_path):
+    opener = gzip.open if file_path.lower().endswith('.gz') else open
+    n = 0
+    with opener(file_path, 'rt') as f:
+        for line in f:
+            if not line.startswith(('track', 'browser', '#')):
+                break
+            n += 1
+    return n
@@ -11,9 +11,10 @@ setup(
     name='cytocad',
     version=__version__,
     packages=find_packages(),
-    package_data={'cytocad.data': ['*.bed', '*.p']},
+    package_data={'cytocad.data': ['*.bed', '*.p', '*.cytoref/*']},
     include_package_data=True,
-    ext_modules=[Extension('cytocad.bam_coverage', ['cytocad/bam_coverage.pyx'])],
+    ext_modules=[Extension('cytocad.bam_coverage', ['cytocad/bam_coverage.pyx']),
+                 Extension('cytocad.segmentation', ['cytocad/segmentation.pyx'])],
     scripts=['cytocad/cytocad'],
     url='https://github.com/cytham/cytocad',
     download_url='https://github.com/cytham/cytocad/releases',
@@ -24,8 +25,9 @@ setup(
     keywords=['cytocad', 'copy number variation', 'CNV', 'whole genome sequencing', 'low depth', 'change point detection'],
     long_description=long_description,
     long_description_content_type="text/markdown",
-    install_requires=['pandas>=1.1.5', 'numpy>=1.17.3', 'scipy>=1.2.1', 'pybedtools>=0.8.2', 'matplotlib>=2.2.3',
+    install_requires=['pandas>=1.1.5', 'numpy>=1.17.3', 'scipy>=1.2.1', 'matplotlib>=2.2.3',
                       'ruptures>=1.1.3', 'pysam>=0.15.3', 'tagore>=1.1.0'],
+    extras_require={'render': ['cairosvg>=2.5.0']},
     python_requires='>=3.6',
     classifiers=[
         "Operating System :: POSIX :: Linux",
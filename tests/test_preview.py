@@ -0,0 +1,69 @@
+import numpy as np
+import pysam
+from cytocad.bam_coverage import bam_parse
+from cytocad.change_detection import probe_coverage, probe_windows
+from cytocad.preview import preview_coverage
+
+
+CHR21_LENGTH = 46709983
+
+
+# Aligned record of a read with no indels
+def record(header, name, flag, pos, cigar, qlen, sa=None):
+    seg = pysam.AlignedSegment(header)
+    seg.query_name = name
+    seg.flag = flag
+    seg.reference_id = 0
+    seg.reference_start = pos
+    seg.mapping_quality = 60
+    seg.cigarstring = cigar
+    seg.query_sequence = 'A' * qlen
+    seg.query_qualities = pysam.qualitystring_to_array('I' * qlen)
+    seg.set_tag('NM', 0)
+    seg.set_tag('AS', 2000)
+    if sa:
+        seg.set_tag('SA', sa)
+    return seg
+
+
+# Indexed BAM with reads over unfiltered probes of chr21, including chimeric reads with supplementary and secondary
+# alignments, a secondary alignment of the same part of a read as its primary, and a placed unmapped read
+def write_bam(path):
+    starts, ends, filtered = probe_windows('hg38', 500000, 10)['chr21']
+    probes = starts[~filtered][:6] + 10
+    header = pysam.AlignmentHeader.from_dict({'HD': {'VN': '1.6', 'SO': 'coordinate'},
+                                              'SQ': [{'SN': 'chr21', 'LN': CHR21_LENGTH}]})
+    a, b, c, d, e, f = (int(p) - 1000 for p in probes)
+    records = [
+        record(header, 'plain', 0, a, '2000M', 2000),
+        record(header, 'duplicate', 1024, a + 100, '2000M', 2000),
+        # Chimeric read with a primary and a supplementary alignment
+        record(header, 'chimeric', 0, b, '2000M2000S', 4000, 'chr21,%i,+,2000S2000M,60,0;' % (c + 1)),
+        record(header, 'chimeric', 2048, c, '2000H2000M', 2000, 'chr21,%i,+,2000M2000S,60,0;' % (b + 1)),
+        # Secondary alignment of the same part of the read as the primary, dropped in a full run
+        record(header, 'plain', 256, d, '2000M', 2000),
+        # Chimeric read with a secondary alignment of a part no other alignment covers, kept in a full run
+        record(header, 'split', 0, d + 300, '2000M2000S', 4000, 'chr21,%i,+,2000H2000M,60,0;' % (e + 1)),
+        record(header, 'split', 256, e, '2000H2000M', 2000, 'chr21,%i,+,2000M2000S,60,0;' % (d + 301)),
+        # Secondary alignment overlapping the supplementary alignment of its read, dropped in a full run
+        record(header, 'chimeric', 256, f, '2000H2000M', 2000, 'chr21,%i,+,2000M2000S,60,0;chr21,%i,+,2000S2000M,60,0;'
+               % (b + 1, c + 1)),
+    ]
+    unmapped = record(header, 'unmapped', 4, f + 200, '2000M', 2000)
+    unmapped.cigarstring = None
+    records.append(unmapped)
+    with pysam.AlignmentFile(str(path), 'wb', header=header) as out:
+        for seg in sorted(records, key=lambda x: x.reference_start):
+            out.write(seg)
+    pysam.index(str(path))
+    return str(path)
+
+
+def test_preview_counts_match_full_run(tmp_path):
+    bam = write_bam(tmp_path / 'reads.bam')
+    probe_cov, depth, upper_cov = preview_coverage(bam, CHR21_LENGTH, 'hg38', 500000, 10)
+    table, basecov = bam_parse(bam)
+    full = probe_coverage(table, 'hg38', 500000, 10)
+    counts, filtered = probe_cov['chr21']
+    assert counts[~filtered].sum() > 0
+    np.testing.assert_array_equal(counts[~filtered], full['chr21'][0][~filtered])